@@ -0,0 +1,173 @@
+import argparse
+import multiprocessing
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from protocol import Connection, CONTROL
+
+# Measures server throughput for different --workers counts.
+# Clients are paired up and keep WINDOW direct messages bouncing between the
+# two of them, so the load is closed-loop and most pairs span two workers.
+#
+#   python benchmark.py --workers 1,2,4 --clients 64 --duration 10
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def connect(host, port, username, password="bench"):
+    context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    sock = context.wrap_socket(socket.socket(socket.AF_INET, socket.SOCK_STREAM), server_hostname=host)
+    sock.connect((host, port))
+    conn = Connection(sock, block_when_full=True)
+    for answer in ("r", username, password):
+        conn.recv_message()
+        conn.send(answer.encode(), CONTROL)
+    result = conn.recv_message()
+    if "successfully" not in result:
+        raise RuntimeError(f"{username}: {result.strip()}")
+    return conn
+
+def run_pair_client(conn, partner, window, start, stop, stats):
+    try:
+        for _ in range(window):
+            conn.send(f"/to:{partner}|{time.perf_counter()}".encode())
+        while True:
+            frame = conn.recv_frame()
+            if frame is None:
+                return
+            message = frame[1].decode(errors="ignore")
+            if not message.startswith("[DM from "):
+                continue
+            now = time.perf_counter()
+            if now >= stop:
+                return
+            if now >= start:
+                stats["count"] += 1
+                stats["latencies"].append(now - float(message.split("]: ", 1)[1]))
+            conn.send(f"/to:{partner}|{now}".encode())
+    except (OSError, ConnectionError):
+        pass  # the partner finished first and its connection is gone
+
+def run_client_process(host, port, names, partners, window, ready, go, results, warmup, duration):
+    conns = [connect(host, port, name) for name in names]
+    ready.put(len(conns))
+    go.wait()
+    start = time.perf_counter() + warmup
+    stop = start + duration
+    # One stats dict per thread, so counting needs no lock; summed at the end.
+    stats = [{"count": 0, "latencies": []} for _ in conns]
+    threads = [threading.Thread(target=run_pair_client, args=(conn, partner, window, start, stop, thread_stats),
+                                daemon=True)
+               for conn, partner, thread_stats in zip(conns, partners, stats)]
+    for thread in threads:
+        thread.start()
+    # A client whose partner stopped first would wait in recv_frame() forever;
+    # closing every connection at stop ends all of them together.
+    time.sleep(max(0, stop - time.perf_counter()))
+    for conn in conns:
+        conn.close()
+    for thread in threads:
+        thread.join(5)
+    count = sum(thread_stats["count"] for thread_stats in stats)
+    latencies = [latency for thread_stats in stats for latency in thread_stats["latencies"][::10]]
+    results.put((count, latencies))
+
+def wait_for_port(host, port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"server did not start on {host}:{port}")
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def run_once(args, worker_count, workdir):
+    # Fresh users file per run so every client can register.
+    users_file = os.path.join(workdir, "users2.json")
+    if os.path.exists(users_file):
+        os.remove(users_file)
+    server = subprocess.Popen([sys.executable, os.path.join(HERE, "server.py"), "--host", args.host,
+                               "--port", str(args.port), "--workers", str(worker_count)],
+                              cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(args.host, args.port)
+        names = [f"bench{i}" for i in range(args.clients)]
+        partners = [names[i ^ 1] for i in range(args.clients)]
+        procs = min(args.client_procs, args.clients // 2)
+        ctx = multiprocessing.get_context("spawn")
+        ready, results, go = ctx.Queue(), ctx.Queue(), ctx.Event()
+        processes = []
+        for p in range(procs):
+            # Keep both members of a pair in the same process.
+            indexes = [i for i in range(args.clients) if (i // 2) % procs == p]
+            process = ctx.Process(target=run_client_process,
+                                  args=(args.host, args.port, [names[i] for i in indexes],
+                                        [partners[i] for i in indexes], args.window, ready, go, results,
+                                        args.warmup, args.duration))
+            process.start()
+            processes.append(process)
+        for _ in processes:
+            ready.get(timeout=60)
+        go.set()
+        count, latencies = 0, []
+        for _ in processes:
+            c, l = results.get(timeout=args.warmup + args.duration + 30)
+            count += c
+            latencies.extend(l)
+        for process in processes:
+            process.join()
+        return count / args.duration, percentile(latencies, 0.5), percentile(latencies, 0.99)
+    finally:
+        server.terminate()
+        server.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput benchmark for server.py --workers")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5600)
+    parser.add_argument("--workers", default=f"1,2,{os.cpu_count() or 1}",
+                        help="comma separated worker counts to compare")
+    parser.add_argument("--clients", type=int, default=64, help="connected clients (rounded down to pairs)")
+    parser.add_argument("--client-procs", type=int, default=os.cpu_count() or 1,
+                        help="processes driving the clients")
+    parser.add_argument("--window", type=int, default=8, help="messages in flight per client")
+    parser.add_argument("--duration", type=float, default=10.0, help="measured seconds per run")
+    parser.add_argument("--warmup", type=float, default=2.0)
+    args = parser.parse_args()
+    args.clients -= args.clients % 2
+    worker_counts = sorted({int(w) for w in args.workers.split(",")})
+
+    workdir = tempfile.mkdtemp(prefix="chat-bench-")
+    try:
+        for name in ("cert.pem", "key.pem"):
+            if not os.path.exists(os.path.join(HERE, name)):
+                print(f"[ERROR] {name} not found next to server.py, see README for the openssl command")
+                sys.exit(1)
+            shutil.copy(os.path.join(HERE, name), workdir)
+
+        print(f"{args.clients} clients, {args.window} messages in flight each, {args.duration:.0f}s per run")
+        print(f"{'workers':>8} {'msgs/s':>10} {'speedup':>8} {'p50 ms':>8} {'p99 ms':>8}")
+        baseline = None
+        for worker_count in worker_counts:
+            rate, p50, p99 = run_once(args, worker_count, workdir)
+            baseline = baseline or rate
+            print(f"{worker_count:>8} {rate:>10.0f} {rate / baseline:>7.2f}x {p50 * 1000:>8.2f} {p99 * 1000:>8.2f}")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
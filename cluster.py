@@ -0,0 +1,130 @@
+import multiprocessing
+import threading
+
+# --- Presence and routing directory ---
+# server.py keeps its own username -> Connection map for the users connected
+# to this process. The directory knows every online user, which worker owns
+# them, and holds the game tables, so that workers can route to each other.
+
+class LocalDirectory:
+    # Single process: everyone is local and nothing is ever routed.
+    def __init__(self):
+        self.worker_id = 0
+        self.presence = {}       # username -> worker id
+        self.games = {}          # (player1, player2) -> game_state
+        self.pending_games = {}  # (inviter, target) -> {'inviter': inviter, 'target': target}
+        self.sessions = {}       # resume token -> (username, expiry time or None while connected)
+        self.users_lock = threading.Lock()
+        self.games_lock = threading.Lock()  # held for every read-modify-write of games / pending_games
+
+    def attach(self, worker_id, deliver):
+        self.worker_id = worker_id
+
+    def register(self, username):
+        self.presence[username] = self.worker_id
+
+    def unregister(self, username):
+        if self.presence.get(username) == self.worker_id:
+            del self.presence[username]
+
+    def is_online(self, username):
+        return username in self.presence
+
+    def users(self):
+        return list(self.presence.keys())
+
+    def route(self, username, item):
+        # Hands item to the worker owning username; False if it is not on another worker.
+        return False
+
+    def publish(self, item):
+        pass
+
+class SharedDirectory(LocalDirectory):
+    # Prefork: tables live in a multiprocessing.Manager, and every worker has
+    # an inbox queue that a thread drains into server.deliver_remote().
+    # Must be created in the parent before the workers are forked.
+    #
+    # Presence is read on every routed message, so each worker keeps its own
+    # copy (local_presence) and lookups never go through the manager. Logins
+    # and logouts update the manager's table under presence_lock and publish
+    # a numbered event; copies apply an event only if it is newer than the
+    # last one seen for that user, since inbox queues don't order events
+    # coming from different workers.
+    def __init__(self, worker_count):
+        self.manager = multiprocessing.Manager()
+        self.worker_id = None
+        self.presence = self.manager.dict()
+        self.games = self.manager.dict()
+        self.pending_games = self.manager.dict()
+        self.sessions = self.manager.dict()
+        self.users_lock = multiprocessing.Lock()
+        self.games_lock = multiprocessing.Lock()
+        self.presence_lock = multiprocessing.Lock()
+        self.presence_version = multiprocessing.Value("Q", 0, lock=False)  # only changed under presence_lock
+        self.local_presence = {}  # username -> (worker id or None, version)
+        self.local_lock = threading.Lock()
+        self.inboxes = [multiprocessing.Queue() for _ in range(worker_count)]
+
+    def attach(self, worker_id, deliver):
+        self.worker_id = worker_id
+        with self.presence_lock:
+            for username, worker in self.presence.items():  # logged in on workers that started first
+                self._apply_presence(username, worker, self.presence_version.value)
+        threading.Thread(target=self._drain_inbox, args=(deliver,), daemon=True).start()
+
+    def register(self, username):
+        with self.presence_lock:
+            self.presence[username] = self.worker_id
+            self._announce(username, self.worker_id)
+
+    def unregister(self, username):
+        with self.presence_lock:
+            if self.presence.get(username) == self.worker_id:
+                del self.presence[username]
+                self._announce(username, None)
+
+    def is_online(self, username):
+        entry = self.local_presence.get(username)
+        return entry is not None and entry[0] is not None
+
+    def users(self):
+        return [username for username, (worker, _) in list(self.local_presence.items()) if worker is not None]
+
+    def _announce(self, username, worker):
+        # Called with presence_lock held.
+        self.presence_version.value += 1
+        version = self.presence_version.value
+        self._apply_presence(username, worker, version)
+        self.publish(("presence", username, worker, version))
+
+    def _apply_presence(self, username, worker, version):
+        with self.local_lock:
+            entry = self.local_presence.get(username)
+            if entry is None or entry[1] < version:
+                self.local_presence[username] = (worker, version)
+
+    def route(self, username, item):
+        entry = self.local_presence.get(username)
+        worker = entry[0] if entry else None
+        if worker is None or worker == self.worker_id:
+            return False
+        self.inboxes[worker].put(item)
+        return True
+
+    def publish(self, item):
+        for worker, inbox in enumerate(self.inboxes):
+            if worker != self.worker_id:
+                inbox.put(item)
+
+    def _drain_inbox(self, deliver):
+        inbox = self.inboxes[self.worker_id]
+        while True:
+            item = inbox.get()
+            if item[0] == "presence":
+                self._apply_presence(*item[1:])
+                continue
+            try:
+                deliver(item)
+            except Exception as e:
+                print(f"[ERROR] Worker {self.worker_id} delivering {item[0]}: {e}")
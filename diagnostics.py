@@ -0,0 +1,218 @@
+import itertools
+import json
+import os
+import socket
+import stat
+import sys
+import threading
+import time
+from collections import Counter
+import protocol
+
+# --- On-demand diagnostics ---
+# An admin socket (Unix domain, local only) accepts one command per line:
+#   profile SECONDS [PATH]   sample every thread's stack, write folded stacks
+#   trace on [PATH]          log receive/parse/dispatch/enqueue/write times per message
+#   trace off
+#   status
+# Nothing here runs until asked: with tracing off the hot paths only test
+# `tracer is None` / `protocol.current_trace is None`.
+#
+#   python diagnostics.py /tmp/chat-admin.sock profile 10
+
+tracer = None             # Tracer while tracing is on
+profiler = None           # SamplingProfiler while a profile is running
+admin = None              # (listening socket, path, inode) while the admin socket is open
+_local = threading.local()
+
+class SamplingProfiler:
+    # Wall-clock sampler over sys._current_frames(). Output is one
+    # "outer;...;inner count" line per distinct stack, the folded format
+    # read by flamegraph.pl and speedscope.
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+
+    def run(self, seconds):
+        me = threading.get_ident()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+            time.sleep(self.interval)
+
+    def write(self, path):
+        with open(path, "w") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+
+class Trace:
+    __slots__ = ("tracer", "trace_id")
+
+    def __init__(self, tracer, trace_id):
+        self.tracer = tracer
+        self.trace_id = trace_id
+
+    def mark(self, stage, **fields):
+        self.tracer.emit(self.trace_id, stage, fields)
+
+class Tracer:
+    # One JSON line per stage: {"trace": id, "stage": ..., "t": seconds}.
+    # enqueue/write appear once per recipient connection, so broadcast
+    # fan-out shows up as the spread between the first and last of them.
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "a", buffering=256 * 1024)
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.prefix = f"{os.getpid()}-"
+
+    def begin(self, user, channel):
+        trace = Trace(self, f"{self.prefix}{next(self.ids)}")
+        trace.mark("receive", user=user, channel=protocol.CHANNEL_NAMES.get(channel, channel))
+        _local.trace = trace
+        return trace
+
+    def end(self, trace):
+        trace.mark("done")
+        _local.trace = None
+
+    def emit(self, trace_id, stage, fields):
+        line = json.dumps(dict(fields, trace=trace_id, stage=stage, t=time.time()))
+        with self.lock:
+            if not self.file.closed:
+                self.file.write(line + "\n")
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def current_trace():
+    return getattr(_local, "trace", None)
+
+def start_tracing(path):
+    global tracer
+    if tracer:
+        return f"already tracing to {tracer.path}"
+    tracer = Tracer(path)
+    protocol.current_trace = current_trace
+    return f"tracing to {path}"
+
+def stop_tracing():
+    global tracer
+    if not tracer:
+        return "not tracing"
+    protocol.current_trace = None
+    stopped, tracer = tracer, None
+    stopped.close()
+    return f"trace written to {stopped.path}"
+
+def run_profile(seconds, path):
+    global profiler
+    if profiler:
+        return "a profile is already running"
+    profiler = SamplingProfiler()
+    try:
+        profiler.run(seconds)
+        profiler.write(path)
+        return f"{profiler.samples} samples written to {path}"
+    finally:
+        profiler = None
+
+def handle_command(line, status):
+    words = line.split()
+    if not words:
+        return ""
+    command, rest = words[0].lower(), words[1:]
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    if command == "profile" and rest:
+        path = rest[1] if len(rest) > 1 else f"profile-{os.getpid()}-{stamp}.folded"
+        return run_profile(float(rest[0]), path)
+    if command == "trace" and rest and rest[0] == "on":
+        return start_tracing(rest[1] if len(rest) > 1 else f"trace-{os.getpid()}-{stamp}.jsonl")
+    if command == "trace" and rest and rest[0] == "off":
+        return stop_tracing()
+    if command == "status":
+        info = dict(status(), tracing=tracer.path if tracer else None, profiling=profiler is not None)
+        return json.dumps(info)
+    return "commands: profile SECONDS [PATH] | trace on [PATH] | trace off | status"
+
+def serve_admin(server, status):
+    while True:
+        try:
+            conn, _ = server.accept()
+        except OSError:
+            return  # stop_admin() closed the socket
+        threading.Thread(target=handle_admin, args=(conn, status), daemon=True).start()
+
+def handle_admin(conn, status):
+    with conn, conn.makefile("rw") as f:
+        for line in f:
+            try:
+                reply = handle_command(line, status)
+            except Exception as e:
+                reply = f"[ERROR] {e}"
+            f.write(reply + "\n")
+            f.flush()
+
+def start_admin(path, status):
+    # status() returns a dict of server facts for the `status` command.
+    global admin
+    if not hasattr(socket, "AF_UNIX"):
+        print("[ERROR] Admin socket needs Unix domain sockets on this platform")
+        return None
+    if os.path.exists(path):
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            print(f"[ERROR] {path} exists and is not a socket, not starting the admin socket")
+            return None
+        os.remove(path)  # left over from a previous run, or the server we are restarting from
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    os.chmod(path, 0o600)
+    server.listen()
+    admin = (server, path, os.stat(path).st_ino)
+    threading.Thread(target=serve_admin, args=(server, status), daemon=True).start()
+    print(f"[INFO] Admin socket at {path}")
+    return server
+
+def stop_admin():
+    # Closes the admin socket and removes its file, unless a restarted server
+    # has already bound a new socket at the same path. Also ends tracing.
+    global admin
+    if not admin:
+        return
+    server, path, inode = admin
+    admin = None
+    if tracer:
+        stop_tracing()
+    try:
+        server.shutdown(socket.SHUT_RDWR)  # wakes serve_admin() out of accept()
+    except OSError:
+        pass
+    server.close()
+    try:
+        if os.stat(path).st_ino == inode:
+            os.remove(path)
+    except OSError:
+        pass
+
+def main():
+    if len(sys.argv) < 3:
+        print("usage: python diagnostics.py ADMIN_SOCKET COMMAND [ARGS...]")
+        sys.exit(1)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(sys.argv[1])
+        s.sendall((" ".join(sys.argv[2:]) + "\n").encode())
+        print(s.makefile().readline().rstrip())
+
+if __name__ == "__main__":
+    main()
@@ -5,28 +5,89 @@ import threading
 import os
 import platform
 import subprocess
+import time
 from PyQt5.QtWidgets import (
-    QApplication, QWidget, QTextEdit, QLineEdit, QPushButton,
+    QApplication, QWidget, QListView, QLineEdit, QPushButton,
     QVBoxLayout, QFileDialog, QInputDialog, QMessageBox, QTabWidget,
-    QListWidget, QLabel, QGridLayout
+    QListWidget, QLabel, QGridLayout, QAbstractItemView, QProgressBar
 )
-from PyQt5.QtCore import pyqtSignal, QObject, Qt
+from PyQt5.QtCore import pyqtSignal, QObject, Qt, QAbstractListModel, QModelIndex, QTimer
+from protocol import Connection, IncomingFile, ProtocolError, CONTROL, FILE, FILE_START, FILE_DATA, FILE_END, FILE_ABORT, parse_file_frame
 
 SERVER_HOST = '127.0.0.1'
 SERVER_PORT = 5555
+CHAT_SCROLLBACK = int(os.environ.get("CHAT_SCROLLBACK", 5000))      # lines kept per chat tab
+UI_FLUSH_INTERVAL_MS = int(os.environ.get("CHAT_UI_FLUSH_MS", 50))  # incoming messages are batched per interval
+DOWNLOAD_DIR = os.environ.get("CHAT_DOWNLOAD_DIR", "received_files")
+PROGRESS_STEP = 256 * 1024  # bytes between file_progress updates
+RECONNECT_ATTEMPTS = 5
+
+# Ring buffer of chat lines; QListView only asks for the rows it is painting.
+class ChatHistoryModel(QAbstractListModel):
+    def __init__(self, scrollback=CHAT_SCROLLBACK):
+        super().__init__()
+        self.capacity = max(1, scrollback)
+        self.lines = [None] * self.capacity
+        self.start = 0
+        self.count = 0
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.count
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid() or index.row() >= self.count:
+            return None
+        return self.lines[(self.start + index.row()) % self.capacity]
+
+    def append_messages(self, messages):
+        if not messages:
+            return
+        if len(messages) >= self.capacity:
+            self.beginResetModel()
+            self.lines = list(messages[-self.capacity:])
+            self.start = 0
+            self.count = self.capacity
+            self.endResetModel()
+            return
+
+        overflow = self.count + len(messages) - self.capacity
+        if overflow > 0:
+            self.beginRemoveRows(QModelIndex(), 0, overflow - 1)
+            for i in range(overflow):
+                self.lines[(self.start + i) % self.capacity] = None
+            self.start = (self.start + overflow) % self.capacity
+            self.count -= overflow
+            self.endRemoveRows()
+
+        self.beginInsertRows(QModelIndex(), self.count, self.count + len(messages) - 1)
+        for message in messages:
+            self.lines[(self.start + self.count) % self.capacity] = message
+            self.count += 1
+        self.endInsertRows()
 
 class ChatTab(QWidget):
-    def __init__(self, chat_name):
+    def __init__(self, chat_name, scrollback=CHAT_SCROLLBACK):
         super().__init__()
         self.chat_name = chat_name
         self.layout = QVBoxLayout()
-        self.output = QTextEdit()
-        self.output.setReadOnly(True)
+        self.model = ChatHistoryModel(scrollback)
+        self.output = QListView()
+        self.output.setModel(self.model)
+        self.output.setUniformItemSizes(True)
+        self.output.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.output.setSelectionMode(QAbstractItemView.ExtendedSelection)
         self.layout.addWidget(self.output)
         self.setLayout(self.layout)
 
     def append_message(self, message):
-        self.output.append(message)
+        self.append_messages([message])
+
+    def append_messages(self, messages):
+        scrollbar = self.output.verticalScrollBar()
+        at_bottom = scrollbar.value() >= scrollbar.maximum()
+        self.model.append_messages(messages)
+        if at_bottom:
+            self.output.scrollToBottom()
 
 class TicTacToeWindow(QWidget):
     def __init__(self, client, opponent):
@@ -52,7 +113,7 @@ class TicTacToeWindow(QWidget):
         if not self.game_active or self.buttons[row][col].text() != " ":
             return
         print(f"[DEBUG] Sending move: row={row}, col={col} to {self.opponent}")
-        self.client.ssl_sock.sendall(f"[TIC_TAC_TOE]:MOVE:{self.opponent}:{row}:{col}".encode())
+        self.client.send_to_server(f"[TIC_TAC_TOE]:MOVE:{self.opponent}:{row}:{col}".encode())
         self.setEnabled(False)  # Disable until server confirms next turn
 
     def update_board(self, board, current_player):
@@ -79,9 +140,9 @@ class TicTacToeWindow(QWidget):
         event.accept()
 
 class Communicator(QObject):
-    message_received = pyqtSignal(str, str)  # chat_name, message
-    general_message = pyqtSignal(str)
+    messages_pending = pyqtSignal()  # emitted once per batch, see ChatClient.post_message
     file_received = pyqtSignal(str, str)  # path, filename
+    file_progress = pyqtSignal(str, int, int)  # filename, bytes received (-1 if aborted), filesize
     invite_received = pyqtSignal(str)
     create_tab = pyqtSignal(str)
     userlist_signal = pyqtSignal(list)
@@ -92,15 +153,15 @@ class Communicator(QObject):
     tictactoe_error = pyqtSignal(str, str)  # message, opponent
 
 class ChatClient(QWidget):
-    def __init__(self):
+    def __init__(self, download_dir=DOWNLOAD_DIR):
         super().__init__()
         self.setWindowTitle("Chat Client")
         self.resize(600, 600)
 
         self.comm = Communicator()
-        self.comm.message_received.connect(self.add_message_to_chat)
-        self.comm.general_message.connect(self.append_to_general)
+        self.comm.messages_pending.connect(self.schedule_flush)
         self.comm.file_received.connect(self.handle_received_file)
+        self.comm.file_progress.connect(self.handle_file_progress)
         self.comm.invite_received.connect(self.handle_invite_gui)
         self.comm.create_tab.connect(self.create_chat_tab)
         self.comm.userlist_signal.connect(self.handle_user_list)
@@ -122,6 +183,8 @@ class ChatClient(QWidget):
         self.logout_btn = QPushButton("Logout")
         self.file_list_label = QLabel("\U0001F4C2 Received Files:")
         self.file_list = QListWidget()
+        self.file_progress = QProgressBar()
+        self.file_progress.setVisible(False)
         self.open_file_btn = QPushButton("Open Selected File")
 
         layout = QVBoxLayout()
@@ -136,6 +199,7 @@ class ChatClient(QWidget):
         layout.addWidget(self.logout_btn)
         layout.addWidget(self.file_list_label)
         layout.addWidget(self.file_list)
+        layout.addWidget(self.file_progress)
         layout.addWidget(self.open_file_btn)
         self.setLayout(layout)
 
@@ -149,24 +213,38 @@ class ChatClient(QWidget):
 
         self.received_files_tab = ChatTab("Received Files")
         self.tab_widget.addTab(self.received_files_tab, "📁 Received Files")
+        self.chat_tabs = {"Received Files": self.received_files_tab}  # chat_name -> ChatTab
+        self.pending_messages = []  # (chat_name, message) waiting for the next UI flush
+        self.pending_lock = threading.Lock()
+        self.flush_scheduled = False
         self.received_files = []
+        self.download_dir = download_dir
         self.selected_targets = []
         self.sock = None
         self.ssl_sock = None
+        self.conn = None
         self.username = ""
         self.tic_tac_toe_windows = {}  # Dictionary to track games by opponent
+        self.session_token = None  # lets us skip the login dialog when the server restarts
+        self.reconnect_at = None
+        self.outbox = None  # messages held while resuming on a restarted server, None otherwise
+        self.outbox_lock = threading.Lock()
 
         self.connect_to_server()
 
+    def open_connection(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        self.ssl_sock = context.wrap_socket(self.sock, server_hostname=SERVER_HOST)
+        self.ssl_sock.connect((SERVER_HOST, SERVER_PORT))
+        print("[DEBUG] Connected to server")
+        return Connection(self.ssl_sock, block_when_full=True)
+
     def connect_to_server(self):
         try:
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
-            context.check_hostname = False
-            context.verify_mode = ssl.CERT_NONE
-            self.ssl_sock = context.wrap_socket(self.sock, server_hostname=SERVER_HOST)
-            self.ssl_sock.connect((SERVER_HOST, SERVER_PORT))
-            print("[DEBUG] Connected to server")
+            self.conn = self.open_connection()
             self.authenticate_user()
             threading.Thread(target=self.receive_messages, daemon=True).start()
         except Exception as e:
@@ -186,19 +264,19 @@ class ChatClient(QWidget):
                 continue
 
             try:
-                data = self.ssl_sock.recv(1024).decode()
+                data = self.conn.recv_message()
                 print(f"[DEBUG] Received: {data}")
-                self.ssl_sock.sendall(action.encode())
+                self.conn.send(action.encode(), CONTROL)
 
-                data = self.ssl_sock.recv(1024).decode()
+                data = self.conn.recv_message()
                 print(f"[DEBUG] Received: {data}")
-                self.ssl_sock.sendall(username.encode())
+                self.conn.send(username.encode(), CONTROL)
 
-                data = self.ssl_sock.recv(1024).decode()
+                data = self.conn.recv_message()
                 print(f"[DEBUG] Received: {data}")
-                self.ssl_sock.sendall(password.encode())
+                self.conn.send(password.encode(), CONTROL)
 
-                result = self.ssl_sock.recv(1024).decode()
+                result = self.conn.recv_message()
                 print(f"[DEBUG] Authentication result: {result}")
                 QMessageBox.information(self, "Authentication", result)
                 if "successfully" in result.lower():
@@ -219,53 +297,68 @@ class ChatClient(QWidget):
             if active_tab and active_tab.chat_name != "Received Files":
                 chat_name = active_tab.chat_name
                 msg = f"{self.username}: {message}"
-                self.ssl_sock.sendall(f"[{chat_name}_MSG]:{msg}".encode())
-                self.comm.message_received.emit(chat_name, msg)
+                self.send_to_server(f"[{chat_name}_MSG]:{msg}".encode())
+                self.add_message_to_chat(chat_name, msg)
             elif self.selected_targets:
                 msg_with_targets = f"/to:{','.join(self.selected_targets)}|{message}"
-                self.ssl_sock.sendall(msg_with_targets.encode())
-                self.comm.general_message.emit(f"\U0001F5E8 You → {', '.join(self.selected_targets)}: {message}")
+                self.send_to_server(msg_with_targets.encode())
+                self.append_to_general(f"\U0001F5E8 You → {', '.join(self.selected_targets)}: {message}")
             else:
-                self.ssl_sock.sendall(f"{self.username}: {message}".encode())
-                self.comm.general_message.emit(f"\U0001F5E8 You: {message}")
+                self.send_to_server(f"{self.username}: {message}".encode())
+                self.append_to_general(f"\U0001F5E8 You: {message}")
             self.input.clear()
 
         if message.lower() in ["[LOGOUT]", "/exit"]:
             self.logout()
 
+    def send_to_server(self, message):
+        # Called from GUI handlers. While a restarting server hands us over the
+        # connection is closed for a while; hold messages and send them once
+        # the session has resumed instead of letting ConnectionError escape a slot.
+        with self.outbox_lock:
+            if self.outbox:
+                self.outbox.append(message)  # keep the order behind messages already held
+                return
+            try:
+                self.conn.send(message)
+            except ConnectionError:
+                if self.outbox is None:
+                    self.append_to_general("\u274C Not connected to the server, message not sent.")
+                else:
+                    self.outbox.append(message)
+
     def send_file(self):
         file_path, _ = QFileDialog.getOpenFileName(self, "Select File")
         if not file_path:
             return
 
         filename = os.path.basename(file_path)
-        filesize = os.path.getsize(file_path)
 
         try:
-            self.ssl_sock.sendall(b"/file")
-            meta = f"{filename}|{filesize}".encode()
-            self.ssl_sock.sendall(meta)
-            with open(file_path, "rb") as f:
-                while True:
-                    data = f.read(4096)
-                    if not data:
-                        break
-                    self.ssl_sock.sendall(data)
-            self.comm.general_message.emit(f"\U0001F4E4 File {filename} sent successfully.")
+            # Queued on the FILE channel; chat and game frames keep going out while it uploads.
+            self.conn.send_file(file_path, filename, on_done=self.file_sent)
+            self.append_to_general(f"\U0001F4E4 Sending file {filename}...")
         except Exception as e:
-            self.comm.general_message.emit(f"\u274C Failed to send file: {e}")
+            self.append_to_general(f"\u274C Failed to send file: {e}")
+
+    def file_sent(self, transfer, error):
+        # Called from the connection's writer thread.
+        if error:
+            self.append_to_general(f"\u274C Failed to send file {transfer.filename}: {error}")
+        else:
+            self.append_to_general(f"\U0001F4E4 File {transfer.filename} sent successfully.")
 
     def request_dm(self):
         target, ok = QInputDialog.getText(self, "Direct Message (Invite)", "Enter target username:")
         if ok and target:
-            self.ssl_sock.sendall(f"[DM_REQUEST]:{target}".encode())
+            self.send_to_server(f"[DM_REQUEST]:{target}".encode())
 
     def request_gc(self):
         participants, ok = QInputDialog.getText(self, "Group Chat (Invite)", "Enter usernames (comma separated):")
         if ok and participants:
             user_list = participants.replace(" ", "").split(",")
             msg = "[GC_REQUEST]:" + ":".join(user_list)
-            self.ssl_sock.sendall(msg.encode())
+            self.send_to_server(msg.encode())
 
     def request_tictactoe(self):
         target, ok = QInputDialog.getText(self, "Tic-Tac-Toe", "Enter opponent username:")
@@ -273,107 +366,181 @@ class ChatClient(QWidget):
             if target in self.tic_tac_toe_windows:
                 QMessageBox.warning(self, "Tic-Tac-Toe", f"You already have an active game with {target}.")
                 return
-            self.ssl_sock.sendall(f"[TIC_TAC_TOE]:REQUEST:{target}".encode())
+            self.send_to_server(f"[TIC_TAC_TOE]:REQUEST:{target}".encode())
 
     def receive_messages(self):
         while True:
-            try:
-                data = self.ssl_sock.recv(4096).decode(errors="ignore")
-                print(f"[DEBUG] Received data: {data}")
-                if not data:
+            self.read_frames()
+            if self.reconnect_at is None or not self.resume_session():
+                break
+
+    def read_frames(self):
+        incoming = {}  # transfer id -> IncomingFile
+        try:
+            while True:
+                try:
+                    frame = self.conn.recv_frame()
+                except Exception as e:
+                    print(f"[DEBUG] Receive error: {e}")
+                    if self.reconnect_at is None:
+                        self.append_to_general(f"\u274C Disconnected from server: {str(e)}")
                     break
-                if data.startswith("/file"):
-                    meta = self.ssl_sock.recv(1024).decode()
-                    print(f"[DEBUG] File meta: {meta}")
-                    filename, filesize = meta.split("|")
-                    filesize = int(filesize)
-                    saved_path = f"received_{filename}"
-                    with open(saved_path, "wb") as f:
-                        remaining = filesize
-                        while remaining > 0:
-                            chunk = self.ssl_sock.recv(min(4096, remaining))
-                            if not chunk:
-                                break
-                            f.write(chunk)
-                            remaining -= len(chunk)
-                    self.received_files.append(saved_path)
-                    self.comm.file_received.emit(saved_path, filename)
-                elif data.startswith("[TIC_TAC_TOE]"):
-                    parts = data.split(":", 2)
-                    action = parts[1]
-                    if action == "INVITE":
-                        inviter = parts[2]
-                        self.comm.tictactoe_invite.emit(inviter)
-                    elif action == "START":
-                        opponent, symbol = parts[2].split(":")
-                        self.comm.tictactoe_start.emit(opponent, symbol)
-                    elif action == "STATE":
-                        board_and_player = parts[2].rsplit(":", 1)
-                        board_str = board_and_player[0]
-                        current_player = board_and_player[1]
-                        board_rows = board_str.split("\n")
-                        board = [row.split("|") for row in board_rows]
-                        print(f"[DEBUG] Parsed board: {board}, current_player: {current_player}")
-                        opponent = [opp for opp, win in self.tic_tac_toe_windows.items() if win.game_active]
-                        opponent = opponent[0] if opponent else ""
-                        self.comm.tictactoe_state.emit(board, current_player, opponent)
-                    elif action == "RESULT":
-                        result = parts[2]
-                        self.comm.tictactoe_result.emit(result)
-                    elif action == "ERROR":
-                        opponent, message = parts[2].split(":", 1)
-                        self.comm.tictactoe_error.emit(message, opponent)
-                elif data.startswith("[INVITE]"):
-                    self.comm.invite_received.emit(data)
-                elif data.startswith("[FILE]:"):
-                    parts = data.split(":")
-                    if len(parts) < 4:
-                        continue
-                    filename, sender, filesize = parts[1], parts[2], int(parts[3])
-                    remaining = filesize
-                    file_data = b""
-                    while remaining > 0:
-                        chunk = self.ssl_sock.recv(min(4096, remaining))
-                        if not chunk:
-                            break
-                        file_data += chunk
-                        remaining -= len(chunk)
-                    saved_path = f"received_{filename}"
-                    with open(saved_path, "wb") as f:
-                        f.write(file_data)
-                    self.received_files.append(saved_path)
-                    self.comm.file_received.emit(saved_path, filename)
-                elif "ACTIVE USERS" in data:
-                    users = data.replace("ACTIVE USERS: ", "").split(", ")
-                    self.comm.userlist_signal.emit(users)
-                elif "_MSG]:" in data:
-                    chat_name, message = data.split("_MSG]:", 1)
-                    self.comm.message_received.emit(chat_name.strip("["), message.strip())
-                else:
-                    self.comm.general_message.emit(data)
+                if frame is None:
+                    break
+                channel, payload = frame
+                try:
+                    if channel == FILE:
+                        self.receive_file_frame(payload, incoming)
+                    else:
+                        self.dispatch_message(payload.decode(errors="ignore"), channel)
+                except Exception as e:
+                    print(f"[DEBUG] Bad message from server: {e}")
+        finally:
+            for transfer in incoming.values():
+                transfer.abort()
+
+    def schedule_reconnect(self, delay):
+        # The server is restarting. It spreads its clients over a window, so
+        # wait for our slot, then drop this connection and resume on the new one.
+        with self.outbox_lock:
+            if self.outbox is not None:
+                return  # already scheduled; drain_clients repeats it to clients still connected at the end
+            self.outbox = []
+        self.reconnect_at = time.monotonic() + delay
+        threading.Timer(delay, self.conn.close).start()
+
+    def resume_session(self):
+        reconnect_at, self.reconnect_at = self.reconnect_at, None
+        self.conn.close()
+        time.sleep(max(0, reconnect_at - time.monotonic()))
+        for attempt in range(RECONNECT_ATTEMPTS):
+            try:
+                conn = self.open_connection()
+                conn.recv_message()
+                conn.send(f"resume:{self.session_token}".encode(), CONTROL)
+                result = conn.recv_message()
             except Exception as e:
-                print(f"[DEBUG] Receive error: {e}")
-                self.comm.general_message.emit(f"\u274C Disconnected from server: {str(e)}")
-                break
+                print(f"[DEBUG] Reconnect attempt {attempt + 1} failed: {e}")
+                time.sleep(0.5 * 2 ** attempt)
+                continue
+            print(f"[DEBUG] Resume result: {result}")
+            if "successfully" in result.lower():
+                with self.outbox_lock:
+                    self.conn = conn
+                    held, self.outbox = self.outbox, None
+                    for message in held:
+                        conn.send(message)
+                return True
+            conn.close()
+            break
+        with self.outbox_lock:
+            held, self.outbox = self.outbox, None
+        if held:
+            self.append_to_general(f"\u274C {len(held)} messages were not sent.")
+        self.append_to_general("\u274C Disconnected from server: could not resume the session, please log in again.")
+        return False
+
+    def receive_file_frame(self, payload, incoming):
+        # File chunks are written to disk on this thread; only progress reaches the GUI.
+        kind, transfer_id, body = parse_file_frame(payload)
+        if kind == FILE_START:
+            incoming[transfer_id] = IncomingFile.from_start(
+                self.download_dir, body, on_progress=self.comm.file_progress.emit, progress_step=PROGRESS_STEP)
+            return
+        transfer = incoming.get(transfer_id)
+        if transfer is None:
+            raise ProtocolError(f"unknown transfer {transfer_id}")
+        if kind == FILE_DATA:
+            transfer.write(body)
+        elif kind == FILE_END:
+            del incoming[transfer_id]
+            transfer.close()
+            print(f"[DEBUG] File {transfer.filename} saved to {transfer.path}")
+            self.received_files.append(transfer.path)
+            self.comm.file_received.emit(transfer.path, transfer.filename)
+        elif kind == FILE_ABORT:
+            del incoming[transfer_id]
+            transfer.abort()
+
+    def dispatch_message(self, data, channel):
+        print(f"[DEBUG] Received data: {data}")
+        if data.startswith("[TIC_TAC_TOE]"):
+            parts = data.split(":", 2)
+            action = parts[1]
+            if action == "INVITE":
+                inviter = parts[2]
+                self.comm.tictactoe_invite.emit(inviter)
+            elif action == "START":
+                opponent, symbol = parts[2].split(":")
+                self.comm.tictactoe_start.emit(opponent, symbol)
+            elif action == "STATE":
+                board_and_player = parts[2].rsplit(":", 1)
+                board_str = board_and_player[0]
+                current_player = board_and_player[1]
+                board_rows = board_str.split("\n")
+                board = [row.split("|") for row in board_rows]
+                print(f"[DEBUG] Parsed board: {board}, current_player: {current_player}")
+                opponent = [opp for opp, win in self.tic_tac_toe_windows.items() if win.game_active]
+                opponent = opponent[0] if opponent else ""
+                self.comm.tictactoe_state.emit(board, current_player, opponent)
+            elif action == "RESULT":
+                result = parts[2]
+                self.comm.tictactoe_result.emit(result)
+            elif action == "ERROR":
+                opponent, message = parts[2].split(":", 1)
+                self.comm.tictactoe_error.emit(message, opponent)
+        elif data.startswith("[INVITE]"):
+            self.comm.invite_received.emit(data)
+        elif data.startswith("[SESSION]:") and channel == CONTROL:
+            self.session_token = data.split(":", 1)[1]
+        elif data.startswith("[RECONNECT]:") and channel == CONTROL:
+            self.schedule_reconnect(float(data.split(":", 1)[1]))
+        elif "ACTIVE USERS" in data:
+            users = data.replace("ACTIVE USERS: ", "").split(", ")
+            self.comm.userlist_signal.emit(users)
+        elif "_MSG]:" in data:
+            chat_name, message = data.split("_MSG]:", 1)
+            self.post_message(chat_name.strip("["), message.strip())
+        else:
+            self.append_to_general(data)
 
     def create_chat_tab(self, chat_name):
+        if chat_name in self.chat_tabs:
+            return self.chat_tabs[chat_name]
         chat_tab = ChatTab(chat_name)
         self.tab_widget.addTab(chat_tab, chat_name)
+        self.chat_tabs[chat_name] = chat_tab
+        return chat_tab
+
+    def post_message(self, chat_name, message):
+        # Safe to call from any thread. Messages are queued and handed to the
+        # GUI in one batch per UI_FLUSH_INTERVAL_MS instead of one signal each.
+        with self.pending_lock:
+            self.pending_messages.append((chat_name, message))
+            if self.flush_scheduled:
+                return
+            self.flush_scheduled = True
+        self.comm.messages_pending.emit()
+
+    def schedule_flush(self):
+        QTimer.singleShot(UI_FLUSH_INTERVAL_MS, self.flush_messages)
+
+    def flush_messages(self):
+        with self.pending_lock:
+            batch = self.pending_messages
+            self.pending_messages = []
+            self.flush_scheduled = False
+        by_chat = {}
+        for chat_name, message in batch:
+            by_chat.setdefault(chat_name, []).append(message)
+        for chat_name, messages in by_chat.items():
+            self.create_chat_tab(chat_name).append_messages(messages)
 
     def add_message_to_chat(self, chat_name, message):
-        found = False
-        for i in range(self.tab_widget.count()):
-            tab = self.tab_widget.widget(i)
-            if tab.chat_name == chat_name:
-                tab.append_message(message)
-                found = True
-                break
-        if not found:
-            self.create_chat_tab(chat_name)
-            self.add_message_to_chat(chat_name, message)
+        self.post_message(chat_name, message)
 
     def append_to_general(self, message):
-        self.add_message_to_chat("General", message)
+        self.post_message("General", message)
 
     def handle_user_list(self, users):
         self.user_list.clear()
@@ -383,6 +550,16 @@ class ChatClient(QWidget):
         self.received_files_tab.append_message(f"Received: {filename}")
         self.file_list.addItem(filename)
 
+    def handle_file_progress(self, filename, received, filesize):
+        if received < 0:
+            self.file_progress.setVisible(False)
+            self.append_to_general(f"\u274C Transfer of {filename} was interrupted.")
+            return
+        percent = 100 if filesize <= 0 else received * 100 // filesize
+        self.file_progress.setFormat(f"{filename}: %p%")
+        self.file_progress.setValue(percent)
+        self.file_progress.setVisible(received < filesize)
+
     def open_selected_file(self):
         selected_items = self.file_list.selectedItems()
         if selected_items:
@@ -404,24 +581,24 @@ class ChatClient(QWidget):
         response = QMessageBox.question(self, "Invitation", msg, QMessageBox.Yes | QMessageBox.No)
         inviter = msg.split(" ")[1]
         reply = "yes" if response == QMessageBox.Yes else "no"
-        self.ssl_sock.sendall(f"[INVITE_REPLY]:{inviter}:{reply}".encode())
+        self.send_to_server(f"[INVITE_REPLY]:{inviter}:{reply}".encode())
 
     def handle_tictactoe_invite(self, inviter):
         if inviter in self.tic_tac_toe_windows:
-            self.ssl_sock.sendall(f"[TIC_TAC_TOE]:REJECT:{inviter}".encode())
-            self.comm.general_message.emit(f"\U0001F6AB Already in a game with {inviter}.")
+            self.send_to_server(f"[TIC_TAC_TOE]:REJECT:{inviter}".encode())
+            self.append_to_general(f"\U0001F6AB Already in a game with {inviter}.")
             return
         response = QMessageBox.question(self, "Tic-Tac-Toe Invite",
                                        f"{inviter} wants to play Tic-Tac-Toe. Accept?",
                                        QMessageBox.Yes | QMessageBox.No)
         reply = "ACCEPT" if response == QMessageBox.Yes else "REJECT"
-        self.ssl_sock.sendall(f"[TIC_TAC_TOE]:{reply}:{inviter}".encode())
+        self.send_to_server(f"[TIC_TAC_TOE]:{reply}:{inviter}".encode())
 
     def handle_tictactoe_start(self, opponent, symbol):
         if opponent not in self.tic_tac_toe_windows:
             self.tic_tac_toe_windows[opponent] = TicTacToeWindow(self, opponent)
             self.tic_tac_toe_windows[opponent].show()
-        self.comm.general_message.emit(f"\U0001F3B2 Tic-Tac-Toe started with {opponent}. You are {symbol}.")
+        self.append_to_general(f"\U0001F3B2 Tic-Tac-Toe started with {opponent}. You are {symbol}.")
 
     def handle_tictactoe_state(self, board, current_player, opponent):
         if opponent in self.tic_tac_toe_windows and self.tic_tac_toe_windows[opponent].game_active:
@@ -431,7 +608,7 @@ class ChatClient(QWidget):
         if opponent in self.tic_tac_toe_windows and self.tic_tac_toe_windows[opponent].game_active:
             self.tic_tac_toe_windows[opponent].show_error(message)
         else:
-            self.comm.general_message.emit(f"\U0001F6AB Tic-Tac-Toe error with {opponent}: {message}")
+            self.append_to_general(f"\U0001F6AB Tic-Tac-Toe error with {opponent}: {message}")
 
     def handle_tictactoe_result(self, result):
         for opponent, window in list(self.tic_tac_toe_windows.items()):
@@ -444,11 +621,11 @@ class ChatClient(QWidget):
                                        QMessageBox.Yes | QMessageBox.No)
         if confirm == QMessageBox.Yes:
             try:
-                self.ssl_sock.sendall("[LOGOUT]".encode())
+                self.conn.send("[LOGOUT]".encode())
             except:
                 pass
             try:
-                self.ssl_sock.close()
+                self.conn.close(timeout=2)
             except:
                 pass
             QApplication.quit()
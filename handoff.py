@@ -0,0 +1,61 @@
+import json
+import os
+import socket
+import subprocess
+import sys
+
+# --- Graceful restart ---
+# The running server starts its successor with one end of a Unix socketpair.
+# The first message carries the listening sockets (SCM_RIGHTS); it and every
+# later message is one JSON line.
+
+MAX_FDS = 256
+
+class HandoffChannel:
+    def __init__(self, sock):
+        self.sock = sock
+        self.pending = b""
+
+    def send_listeners(self, listeners, **state):
+        payload = json.dumps(dict(state, type="listeners")).encode() + b"\n"
+        socket.send_fds(self.sock, [payload], [listener.fileno() for listener in listeners])
+
+    def receive_listeners(self):
+        self.pending, fds, _, _ = socket.recv_fds(self.sock, 65536, MAX_FDS)
+        listeners = [socket.socket(fileno=fd) for fd in fds]
+        return listeners, next(self.messages())
+
+    def send(self, kind, **state):
+        self.sock.sendall(json.dumps(dict(state, type=kind)).encode() + b"\n")
+
+    def messages(self):
+        while True:
+            while b"\n" not in self.pending:
+                data = self.sock.recv(65536)
+                if not data:
+                    return
+                self.pending += data
+            line, self.pending = self.pending.split(b"\n", 1)
+            yield json.loads(line.decode())
+
+    def close(self):
+        self.sock.close()
+
+def start_successor(script, args):
+    # Starts `python script args... --handoff-fd N` in its own session and
+    # returns the channel to it.
+    parent_sock, child_sock = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    command = [sys.executable, script] + list(args) + ["--handoff-fd", str(child_sock.fileno())]
+    process = subprocess.Popen(command, pass_fds=[child_sock.fileno()], start_new_session=True, cwd=os.getcwd())
+    child_sock.close()
+    return process, HandoffChannel(parent_sock)
+
+def open_handoff(fd):
+    return HandoffChannel(socket.socket(fileno=fd))
+
+def encode_table(table):
+    # Game tables are keyed by (player1, player2) tuples, which JSON can't hold.
+    return [[list(key), value] for key, value in table.items()]
+
+def decode_table(rows):
+    return {tuple(key): value for key, value in rows}
@@ -0,0 +1,360 @@
+import itertools
+import os
+import socket
+import struct
+import threading
+from collections import deque
+
+# --- Wire format ---
+# Every message is one frame: 1 byte channel, 4 byte payload length, payload.
+# Channels share one connection; lower numbers are sent first.
+CONTROL = 0   # auth, presence, invites, server notices
+GAME = 1      # tic-tac-toe
+CHAT = 2      # public, room and direct messages
+FILE = 3      # bulk file transfers, sent only when nothing else is queued
+CHANNEL_NAMES = {CONTROL: "control", GAME: "game", CHAT: "chat", FILE: "file"}
+
+FRAME_HEADER = struct.Struct("!BI")
+MAX_FRAME_SIZE = 1 << 20
+
+# FILE channel payloads start with a kind and a transfer id so several
+# transfers can be interleaved on one connection.
+FILE_HEADER = struct.Struct("!BI")
+FILE_START = 0   # followed by "filename|size|sender"
+FILE_DATA = 1    # followed by file bytes
+FILE_END = 2
+FILE_ABORT = 3
+
+FILE_CHUNK_SIZE = 16 * 1024     # a higher priority frame waits for at most one chunk
+WRITE_BATCH_SIZE = 64 * 1024    # small frames queued together go out in one sendall
+RECV_BUFFER_SIZE = 64 * 1024
+SEND_BUFFER_SIZE = 128 * 1024   # keeps the kernel from queueing megabytes of file data ahead of chat
+MAX_QUEUED_BYTES = 4 * 1024 * 1024  # a reader this far behind is dropped instead of buffered without limit
+MAX_ACTIVE_TRANSFERS = 8  # files interleaved at once per connection; later ones wait their turn
+
+# Set by diagnostics while tracing is on: returns the Trace of the message
+# being handled on the calling thread, or None.
+current_trace = None
+
+CONTROL_PREFIXES = (b"[AUTH]", b"[SERVER]", b"ACTIVE USERS", b"[INVITE", b"[DM_REQUEST]",
+                    b"[GC_REQUEST]", b"[LOGOUT]", b"[SESSION]", b"[RECONNECT]")
+# Only the server may send these; it refuses to relay client text that starts with one.
+SERVER_PREFIXES = (b"[AUTH]", b"[SERVER]", b"ACTIVE USERS", b"[INVITE]", b"[SESSION]", b"[RECONNECT]")
+
+class ProtocolError(Exception):
+    pass
+
+def channel_for(message):
+    if message.startswith(b"[TIC_TAC_TOE]"):
+        return GAME
+    if message.startswith(CONTROL_PREFIXES):
+        return CONTROL
+    return CHAT
+
+def encode_frame(channel, payload):
+    return FRAME_HEADER.pack(channel, len(payload)) + payload
+
+def parse_file_frame(payload):
+    if len(payload) < FILE_HEADER.size:
+        raise ProtocolError(f"short file frame: {len(payload)} bytes")
+    kind, transfer_id = FILE_HEADER.unpack_from(payload)
+    return kind, transfer_id, payload[FILE_HEADER.size:]
+
+# Reads an outgoing file one chunk at a time, only when the writer asks for it.
+class OutgoingFile:
+    def __init__(self, transfer_id, path, filename, sender="", on_done=None):
+        self.transfer_id = transfer_id
+        self.path = path
+        self.filename = filename
+        self.sender = sender
+        self.size = os.path.getsize(path)
+        self.sent = 0
+        self.file = None
+        self.finished = False
+        self.on_done = on_done
+
+    def next_frame(self):
+        try:
+            if self.file is None:
+                self.file = open(self.path, "rb")
+                meta = f"{self.filename}|{self.size}|{self.sender}".encode()
+                return self._frame(FILE_START, meta)
+            data = self.file.read(FILE_CHUNK_SIZE)
+            if data:
+                self.sent += len(data)
+                return self._frame(FILE_DATA, data)
+            self._finish(None)
+            return self._frame(FILE_END)
+        except OSError as e:
+            self._finish(e)
+            return self._frame(FILE_ABORT)
+
+    def abort(self, error):
+        self._finish(error)
+
+    def _frame(self, kind, body=b""):
+        return encode_frame(FILE, FILE_HEADER.pack(kind, self.transfer_id) + body)
+
+    def _finish(self, error):
+        if self.finished:
+            return
+        self.finished = True
+        if self.file:
+            self.file.close()
+        if self.on_done:
+            self.on_done(self, error)
+
+# Streams one incoming file straight to disk as its chunks arrive.
+class IncomingFile:
+    def __init__(self, directory, filename, filesize, sender="", on_progress=None, progress_step=256 * 1024,
+                 path=None):
+        self.filename = os.path.basename(filename)
+        self.filesize = filesize
+        self.sender = sender
+        self.received = 0
+        self.reported = 0
+        self.on_progress = on_progress
+        self.progress_step = progress_step
+        os.makedirs(directory, exist_ok=True)
+        if path:
+            self.path, self.file = path, open(path, "wb")
+        else:
+            self.path, self.file = self._create(directory)
+        self._report()
+
+    @classmethod
+    def from_start(cls, directory, meta, **kwargs):
+        filename, filesize, sender = meta.decode(errors="ignore").split("|", 2)
+        filesize = int(filesize)
+        if filesize < 0:
+            raise ProtocolError(f"invalid filesize {filesize}")
+        return cls(directory, filename, filesize, sender, **kwargs)
+
+    def _create(self, directory):
+        # Never overwrites: a taken name, possibly by a transfer still in
+        # progress, becomes "name (1).ext", "name (2).ext", ...
+        stem, extension = os.path.splitext(self.filename)
+        for n in itertools.count():
+            path = os.path.join(directory, self.filename if n == 0 else f"{stem} ({n}){extension}")
+            try:
+                return path, open(path, "xb")
+            except FileExistsError:
+                continue
+
+    @property
+    def done(self):
+        return self.received >= self.filesize
+
+    def write(self, data):
+        if self.received + len(data) > self.filesize:
+            raise ProtocolError(f"{self.filename}: more data than announced")
+        self.file.write(data)
+        self.received += len(data)
+        if self.done or self.received - self.reported >= self.progress_step:
+            self._report()
+
+    def close(self):
+        self.file.close()
+        if not self.done:
+            raise ProtocolError(f"{self.filename}: ended at {self.received}/{self.filesize} bytes")
+
+    def abort(self):
+        self.file.close()
+        print(f"[DEBUG] Transfer of {self.filename} interrupted at {self.received}/{self.filesize} bytes")
+        if self.on_progress:
+            self.on_progress(self.filename, -1, self.filesize)
+
+    def _report(self):
+        self.reported = self.received
+        if self.on_progress:
+            self.on_progress(self.filename, self.received, self.filesize)
+
+# One framed connection. send() and send_file() only queue; a writer thread
+# drains control, game and chat frames first and round-robins file chunks
+# between transfers when nothing else is waiting. Once max_queued_bytes are
+# waiting, send() blocks until the writer catches up (block_when_full, for
+# clients) or the peer is disconnected as too slow (the server's default).
+class Connection:
+    def __init__(self, sock, max_queued_bytes=MAX_QUEUED_BYTES, block_when_full=False):
+        self.sock = sock
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER_SIZE)
+        except OSError:
+            pass
+        self.queues = {CONTROL: deque(), GAME: deque(), CHAT: deque(), FILE: deque()}
+        self.queued_bytes = 0
+        self.max_queued_bytes = max_queued_bytes
+        self.block_when_full = block_when_full
+        self.blocked_senders = 0
+        self.transfers = deque()          # being sent, round-robin
+        self.waiting_transfers = deque()  # queued behind MAX_ACTIVE_TRANSFERS, not opened yet
+        self.next_transfer_id = 0
+        self.cond = threading.Condition()
+        self.closing = False
+        self.closed = False
+        self.buf = bytearray(RECV_BUFFER_SIZE)
+        self.view = memoryview(self.buf)
+        self.pending = bytearray()
+        self.trace_marks = {}  # id(frame) -> (frame, Trace), only filled while tracing
+        self.writer = threading.Thread(target=self._write_loop, daemon=True)
+        self.writer.start()
+
+    def send(self, message, channel=None):
+        if channel is None:
+            channel = channel_for(message)
+        frame = encode_frame(channel, message)
+        hook = current_trace
+        trace = hook() if hook is not None else None
+        with self.cond:
+            while self.queued_bytes + len(frame) > self.max_queued_bytes and self.queued_bytes and not self.closing:
+                if not self.block_when_full:
+                    self._abandon(f"{self.queued_bytes} bytes queued")
+                self.blocked_senders += 1
+                self.cond.wait()
+                self.blocked_senders -= 1
+            if self.closing:
+                raise ConnectionError("connection closed")
+            self.queues[channel].append(frame)
+            self.queued_bytes += len(frame)
+            if trace:
+                self.trace_marks[id(frame)] = (frame, trace)
+            self.cond.notify_all()  # blocked senders wait on the same condition as the writer
+        if trace:
+            trace.mark("enqueue", channel=CHANNEL_NAMES[channel], queued=len(self.queues[channel]))
+
+    def send_file(self, path, filename, sender="", on_done=None):
+        with self.cond:
+            if self.closing:
+                raise ConnectionError("connection closed")
+            self.next_transfer_id += 1
+            transfer = OutgoingFile(self.next_transfer_id, path, filename, sender, on_done)
+            if len(self.transfers) < MAX_ACTIVE_TRANSFERS:
+                self.transfers.append(transfer)
+            else:
+                self.waiting_transfers.append(transfer)
+            self.cond.notify_all()
+        return transfer
+
+    def recv_frame(self):
+        # Returns (channel, payload), or None once the peer has closed.
+        header_size = FRAME_HEADER.size
+        while True:
+            if len(self.pending) >= header_size:
+                channel, length = FRAME_HEADER.unpack_from(self.pending)
+                if channel not in CHANNEL_NAMES or length > MAX_FRAME_SIZE:
+                    raise ProtocolError(f"bad frame header: channel={channel} length={length}")
+                end = header_size + length
+                if len(self.pending) >= end:
+                    payload = bytes(self.pending[header_size:end])
+                    del self.pending[:end]
+                    return channel, payload
+            n = self.sock.recv_into(self.buf)
+            if not n:
+                return None
+            self.pending += self.view[:n]
+
+    def recv_message(self):
+        frame = self.recv_frame()
+        if frame is None:
+            raise ConnectionError("connection closed")
+        return frame[1].decode(errors="ignore")
+
+    def close(self, timeout=None):
+        # Queued control/game/chat frames are flushed first; unfinished file transfers are dropped.
+        with self.cond:
+            self.closing = True
+            self.cond.notify_all()
+        if timeout is not None and threading.current_thread() is not self.writer:
+            self.writer.join(timeout)
+
+    def _abandon(self, reason):
+        # Called with self.cond held. The writer may be stuck in sendall() on
+        # a peer that stopped reading, so shut the socket down under it.
+        print(f"[INFO] Dropping slow connection: {reason}")
+        self.closing = True
+        for queue in self.queues.values():
+            queue.clear()
+        self.queued_bytes = 0
+        self.cond.notify_all()
+        try:
+            socket.socket.shutdown(self.sock, socket.SHUT_RDWR)  # not SSLSocket.shutdown, which unwraps TLS
+        except OSError:
+            pass
+        raise ConnectionError(f"peer too slow, {reason}")
+
+    def _take_frames(self):
+        frames = []
+        size = 0
+        for channel in (CONTROL, GAME, CHAT):
+            queue = self.queues[channel]
+            while queue and size < WRITE_BATCH_SIZE:
+                frame = queue.popleft()
+                frames.append(frame)
+                size += len(frame)
+        self.queued_bytes -= size
+        if self.blocked_senders:
+            self.cond.notify_all()
+        return frames
+
+    def _mark_written(self, frames):
+        with self.cond:
+            marks = [self.trace_marks.pop(id(frame), None) for frame in frames]
+        for mark in marks:
+            if mark:
+                mark[1].mark("write", batch=len(frames))
+
+    def _write_loop(self):
+        error = None
+        try:
+            while True:
+                transfer = None
+                with self.cond:
+                    while not self.closing and not self.transfers and not any(self.queues.values()):
+                        self.cond.wait()
+                    frames = self._take_frames()
+                    if not frames:
+                        if self.closing:
+                            break
+                        if self.queues[FILE]:
+                            # Prebuilt FILE frames (replay.py) go out one per turn, like a chunk.
+                            frames = [self.queues[FILE].popleft()]
+                            self.queued_bytes -= len(frames[0])
+                            if self.blocked_senders:
+                                self.cond.notify_all()
+                        else:
+                            transfer = self.transfers[0]
+                            self.transfers.rotate(-1)
+                if frames:
+                    self.sock.sendall(b"".join(frames))
+                    if self.trace_marks:
+                        self._mark_written(frames)
+                    continue
+                data = transfer.next_frame()
+                if transfer.finished:
+                    with self.cond:
+                        self.transfers.remove(transfer)
+                        if self.waiting_transfers:
+                            self.transfers.append(self.waiting_transfers.popleft())
+                self.sock.sendall(data)
+        except Exception as e:
+            error = e
+            print(f"[DEBUG] Connection writer stopped: {e}")
+        finally:
+            with self.cond:
+                self.closing = True
+                self.closed = True
+                transfers = list(self.transfers) + list(self.waiting_transfers)
+                self.transfers.clear()
+                self.waiting_transfers.clear()
+                for queue in self.queues.values():
+                    queue.clear()
+                self.queued_bytes = 0
+                self.trace_marks.clear()
+                self.cond.notify_all()
+            for transfer in transfers:
+                transfer.abort(error or ConnectionError("connection closed"))
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.sock.close()
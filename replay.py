@@ -0,0 +1,268 @@
+import argparse
+import heapq
+import json
+import re
+import socket
+import ssl
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+from protocol import Connection, CONTROL, GAME, FILE
+from traffic import OPEN, FRAME, CLOSE, message_type, read_capture
+
+# Replays a capture made with `server.py --record` against a running server.
+# Every recorded connection becomes a simulated client that logs in as the
+# recorded (or pseudonymous) user and sends the recorded frames in the
+# recorded order, at the recorded pace divided by --speed.
+#
+#   python replay.py capture.rec --speed 4 --report run.json --baseline base.json
+#
+# Point it at a scratch server: users that don't exist yet are registered
+# with --password.
+
+TAG = re.compile(rb"#r(\d+)#")
+TAGGED_TYPES = ("chat", "room", "dm")  # first delivery to any client is the latency
+RESPONSE_TYPES = {"game_move": GAME}   # the sender's next frame on this channel is the latency
+
+def load_records(paths):
+    # Captures from several prefork workers, or from before and after a
+    # restart, are merged by wall-clock time.
+    return list(heapq.merge(*(read_tagged(index, path) for index, path in enumerate(paths)),
+                            key=lambda record: record[0]))
+
+def read_tagged(index, path):
+    # Connection ids are only unique within one capture file.
+    for wall_time, connection_id, kind, channel, payload in read_capture(path):
+        yield wall_time, (index, connection_id), kind, channel, payload
+
+def tag_payload(kind, payload, seq):
+    # Stamps a sequence number into the message body so receivers can match it.
+    tag = f"#r{seq}#".encode()
+    if kind == "dm":
+        head, sep, body = payload.partition(b"|")
+    elif kind == "room":
+        head, sep, body = payload.partition(b"_MSG]:")
+    else:
+        head, sep, body = b"", b"", payload
+    return head + sep + tag + body[len(tag):]
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = defaultdict(int)
+        self.latencies = defaultdict(list)
+        self.tagged = {}  # seq -> (type, send time), removed on first delivery
+        self.received = 0
+        self.last_delivery = None
+
+    def delivered(self, kind, latency, now):
+        with self.lock:
+            self.latencies[kind].append(latency)
+            self.last_delivery = max(now, self.last_delivery or now)
+
+class SimulatedClient:
+    def __init__(self, args, username, stats):
+        self.username = username
+        self.stats = stats
+        self.pending_responses = deque()  # (type, send time) waiting for a reply on GAME
+        context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        sock = context.wrap_socket(socket.socket(socket.AF_INET, socket.SOCK_STREAM), server_hostname=args.host)
+        sock.connect((args.host, args.port))
+        self.conn = Connection(sock, block_when_full=True)
+        for choice in ("r", "l"):
+            for answer in (choice, username, args.password):
+                self.conn.recv_message()
+                self.conn.send(answer.encode(), CONTROL)
+            result = self.conn.recv_message()
+            if "successfully" in result:
+                break
+        else:
+            raise RuntimeError(f"could not log in as {username}: {result.strip()}")
+        threading.Thread(target=self.read_loop, daemon=True).start()
+
+    def send(self, kind, channel, payload):
+        now = time.perf_counter()
+        if kind in RESPONSE_TYPES:
+            self.pending_responses.append((kind, now))
+        self.conn.send(payload, channel)
+        with self.stats.lock:
+            self.stats.sent[kind] += 1
+
+    def read_loop(self):
+        try:
+            while True:
+                frame = self.conn.recv_frame()
+                if frame is None:
+                    return
+                channel, payload = frame
+                now = time.perf_counter()
+                stats = self.stats
+                with stats.lock:
+                    stats.received += 1
+                if channel == GAME and self.pending_responses:
+                    kind, sent_at = self.pending_responses.popleft()
+                    stats.delivered(kind, now - sent_at, now)
+                match = TAG.search(payload) if channel != FILE else None
+                if match:
+                    with stats.lock:
+                        sent = stats.tagged.pop(int(match.group(1)), None)
+                    if sent:
+                        stats.delivered(sent[0], now - sent[1], now)
+        except (OSError, ConnectionError):
+            pass
+
+def replay(args, records):
+    # Recorded logouts and closes are held back until the settle period, so a
+    # client closed early by an accelerated replay still receives (and times)
+    # what was sent to it.
+    stats = Stats()
+    clients = {}
+    finished = {}  # username -> client whose recorded connection has ended
+    logouts = {}   # connection id -> recorded logout frame, sent at the end
+    seq = 0
+    first = records[0][0]
+    start = time.perf_counter()
+    for wall_time, connection_id, kind, channel, payload in records:
+        if args.speed > 0:
+            delay = start + (wall_time - first) / args.speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        if kind == OPEN:
+            username = payload.decode()
+            previous = finished.pop(username, None)
+            if previous:
+                previous.conn.close(timeout=1)  # the server allows one connection per user
+            try:
+                clients[connection_id] = SimulatedClient(args, username, stats)
+            except Exception as e:
+                print(f"[ERROR] Connection {connection_id}: {e}")
+        elif kind == CLOSE:
+            client = clients.pop(connection_id, None)
+            if client:
+                finished[client.username] = client
+        elif kind == FRAME and connection_id in clients:
+            mtype = message_type(channel, payload)
+            if mtype == "logout":
+                logouts[connection_id] = (clients[connection_id], channel, payload)
+                continue
+            if mtype in TAGGED_TYPES:
+                seq += 1
+                payload = tag_payload(mtype, payload, seq)
+                with stats.lock:
+                    stats.tagged[seq] = (mtype, time.perf_counter())
+            try:
+                clients[connection_id].send(mtype, channel, payload)
+            except ConnectionError:
+                pass
+    duration = time.perf_counter() - start
+    time.sleep(args.settle)
+    for client, channel, payload in logouts.values():
+        try:
+            client.conn.send(payload, channel)
+        except ConnectionError:
+            pass
+    for client in list(clients.values()) + list(finished.values()):
+        client.conn.close(timeout=1)
+    return stats, start, duration
+
+def build_report(stats, start, duration, args):
+    # Rates count measured deliveries up to the last one, not how fast the
+    # replayer queued its sends.
+    elapsed = stats.last_delivery - start if stats.last_delivery else duration
+    types = {}
+    for kind in sorted(set(stats.sent) | set(stats.latencies)):
+        latencies = stats.latencies.get(kind, [])
+        types[kind] = {
+            "sent": stats.sent.get(kind, 0),
+            "rate": len(latencies) / elapsed if elapsed else 0.0,
+            "measured": len(latencies),
+            "p50_ms": ms(percentile(latencies, 0.50)),
+            "p95_ms": ms(percentile(latencies, 0.95)),
+            "p99_ms": ms(percentile(latencies, 0.99)),
+        }
+    return {
+        "speed": args.speed,
+        "duration_s": elapsed,
+        "sent": sum(stats.sent.values()),
+        "measured": sum(len(latencies) for latencies in stats.latencies.values()),
+        "received": stats.received,
+        "throughput": sum(len(latencies) for latencies in stats.latencies.values()) / elapsed if elapsed else 0.0,
+        "types": types,
+    }
+
+def ms(seconds):
+    return None if seconds is None else seconds * 1000
+
+def print_report(report, baseline=None, tolerance=0.2):
+    # Returns the list of regressions against the baseline.
+    regressions = []
+    print(f"Replayed {report['sent']} frames, {report['measured']} deliveries measured in {report['duration_s']:.1f}s "
+          f"({report['throughput']:.0f}/s, {report['received']} frames received)")
+    print(f"{'type':<10} {'sent':>7} {'rate/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}  vs baseline")
+    for kind, row in report["types"].items():
+        base = (baseline or {}).get("types", {}).get(kind)
+        notes = []
+        if base:
+            if row["p95_ms"] is not None and base["p95_ms"]:
+                change = row["p95_ms"] / base["p95_ms"] - 1
+                notes.append(f"p95 {change:+.0%}")
+                if change > tolerance:
+                    regressions.append(f"{kind} p95 latency {base['p95_ms']:.2f} -> {row['p95_ms']:.2f} ms")
+            if base["rate"]:
+                change = row["rate"] / base["rate"] - 1
+                notes.append(f"rate {change:+.0%}")
+                if change < -tolerance:
+                    regressions.append(f"{kind} rate {base['rate']:.0f} -> {row['rate']:.0f}/s")
+        print(f"{kind:<10} {row['sent']:>7} {row['rate']:>9.1f} {fmt(row['p50_ms'])} {fmt(row['p95_ms'])} "
+              f"{fmt(row['p99_ms'])}  {', '.join(notes)}")
+    return regressions
+
+def fmt(value):
+    return f"{'-':>8}" if value is None else f"{value:>8.2f}"
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured chat traffic against a server")
+    parser.add_argument("captures", nargs="+", help="files written by server.py --record")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5555)
+    parser.add_argument("--speed", type=float, default=1.0, help="time compression, 0 = as fast as possible")
+    parser.add_argument("--password", default="replay", help="password for the simulated users")
+    parser.add_argument("--settle", type=float, default=2.0, help="seconds to wait for deliveries at the end")
+    parser.add_argument("--report", help="write the results as JSON")
+    parser.add_argument("--baseline", help="compare with a report from an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed fractional p95 increase / rate decrease before failing")
+    args = parser.parse_args()
+
+    records = load_records(args.captures)
+    if not records:
+        print("[ERROR] No records in capture")
+        sys.exit(1)
+    stats, start, duration = replay(args, records)
+    report = build_report(stats, start, duration, args)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = print_report(report, baseline, args.tolerance)
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump(report, f, indent=4)
+    if regressions:
+        print("[ERROR] Regressions against baseline:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
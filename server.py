@@ -4,14 +4,37 @@ import threading
 import json
 import hashlib
 import os
+import sys
+import signal
+import argparse
+import multiprocessing
+import random
+import secrets
+import shutil
+import itertools
+import time
+from cluster import LocalDirectory, SharedDirectory
+from handoff import start_successor, open_handoff, encode_table, decode_table
+from traffic import Recorder, Redactor, message_type
+import diagnostics
+from protocol import (Connection, IncomingFile, ProtocolError, CHAT, FILE, FILE_START, FILE_DATA, FILE_ABORT,
+                      SERVER_PREFIXES, parse_file_frame)
 
 # --- Global Structures ---
-clients = {}           # username -> conn
-client_names = {}      # conn -> username
+clients = {}           # username -> Connection, users connected to this process
+client_names = {}      # Connection -> username
 lock = threading.Lock()
 received_dir = "received_files"
-games = {}             # (player1, player2) -> game_state
-pending_games = {}     # (inviter, target) -> {'inviter': inviter, 'target': target}
+directory = LocalDirectory()            # every online user, shared between workers in prefork mode
+games = directory.games                 # (player1, player2) -> game_state
+pending_games = directory.pending_games # (inviter, target) -> {'inviter': inviter, 'target': target}
+draining = threading.Event()            # set while this process moves its users to a new server
+restart_requested = False               # set by SIGHUP
+drain_requested = False                 # set by SIGUSR1 in prefork workers
+_users_cache = (None, {})               # (mtime, size) of USER_FILE -> users
+recorder = None                         # traffic.Recorder when started with --record
+redactor = None                         # traffic.Redactor with --redact; its key goes to a restarted server
+upload_ids = itertools.count(1)         # uploads are stored under unique names, see receive_file
 
 # --- File for storing users ---
 USER_FILE = "users2.json"
@@ -25,119 +48,228 @@ os.makedirs(received_dir, exist_ok=True)
 # --- Server Setup ---
 HOST = '127.0.0.1'
 PORT = 5555
+DRAIN_WINDOW = 30  # seconds over which a restarting server spreads its clients' reconnects
+session_ttl = 2 * DRAIN_WINDOW  # how long a handed-over session token stays usable, set from --drain-window
 
 # --- Helper Functions ---
 def hash_password(password):
     return hashlib.sha256(password.encode()).hexdigest()
 
 def load_users():
+    # Re-read only when the file changed, so a burst of logins doesn't parse it every time.
+    global _users_cache
     try:
-        with open(USER_FILE, "r") as f:
-            return json.load(f)
+        stat = os.stat(USER_FILE)
+        version = (stat.st_mtime_ns, stat.st_size)
+        if version != _users_cache[0]:
+            with open(USER_FILE, "r") as f:
+                _users_cache = (version, json.load(f))
+        return dict(_users_cache[1])
     except json.JSONDecodeError:
         print("[ERROR] Invalid JSON format.")
         return {}
 
 def save_users(users):
-    with open(USER_FILE, "w") as f:
+    tmp_file = f"{USER_FILE}.{os.getpid()}.tmp"
+    with open(tmp_file, "w") as f:
         json.dump(users, f, indent=4)
+    os.replace(tmp_file, USER_FILE)  # readers in other workers never see a half-written file
 
 def authenticate(conn):
-    conn.sendall(b"[AUTH] Register or Login? (r/l):")
-    choice = conn.recv(1024).decode().strip().lower()
-    conn.sendall(b"[AUTH] Username:")
-    username = conn.recv(1024).decode().strip()
-    conn.sendall(b"[AUTH] Password:")
-    password = conn.recv(1024).decode().strip()
-    users = load_users()
+    conn.send(b"[AUTH] Register or Login? (r/l):")
+    choice = conn.recv_message().strip()
+    if choice.startswith("resume:"):
+        return resume_session(conn, choice[len("resume:"):])
+    choice = choice.lower()
+    conn.send(b"[AUTH] Username:")
+    username = conn.recv_message().strip()
+    conn.send(b"[AUTH] Password:")
+    password = conn.recv_message().strip()
 
     if choice == 'r':
-        if username in users:
-            conn.sendall(b"[AUTH] Username already exists.\n")
-            return None
-        users[username] = hash_password(password)
-        save_users(users)
-        conn.sendall(b"[AUTH] Registered successfully.\n")
+        with directory.users_lock:
+            users = load_users()
+            if username in users:
+                conn.send(b"[AUTH] Username already exists.\n")
+                return None
+            users[username] = hash_password(password)
+            save_users(users)
+        conn.send(b"[AUTH] Registered successfully.\n")
         return username
     elif choice == 'l':
+        users = load_users()
         if username not in users or users[username] != hash_password(password):
-            conn.sendall(b"[AUTH] Invalid credentials.\n")
+            conn.send(b"[AUTH] Invalid credentials.\n")
             return None
-        conn.sendall(b"[AUTH] Logged in successfully.\n")
+        conn.send(b"[AUTH] Logged in successfully.\n")
         return username
     else:
-        conn.sendall(b"[AUTH] Invalid choice.\n")
+        conn.send(b"[AUTH] Invalid choice.\n")
         return None
 
-def broadcast(message, exclude=None):
-    for client in clients.values():
+def resume_session(conn, token):
+    # Clients asked to reconnect by a restarting server come back with the
+    # token from [SESSION] instead of going through the login dialog again.
+    username, expires = directory.sessions.pop(token, None) or (None, None)
+    if not username or (expires is not None and expires < time.time()):
+        conn.send(b"[AUTH] Session expired.\n")
+        return None
+    conn.send(b"[AUTH] Resumed successfully.\n")
+    return username
+
+def new_session(conn, username):
+    token = secrets.token_hex(16)
+    directory.sessions[token] = (username, None)  # no expiry while the user is connected
+    conn.send(f"[SESSION]:{token}".encode())
+    return token
+
+def broadcast(message, exclude=None, channel=None):
+    # Text relayed from a client goes out with channel=CHAT, so it can never
+    # arrive on CONTROL looking like a server command.
+    broadcast_local(message, exclude, channel)
+    directory.publish(("broadcast", message, channel))
+
+def broadcast_local(message, exclude=None, channel=None):
+    for client in list(clients.values()):
         if client != exclude:
             try:
-                client.sendall(message)
+                client.send(message, channel)
             except:
                 pass
 
+def send_to_user(username, message):
+    # Sends to a user on this process, or routes it to the worker they are connected to.
+    conn = clients.get(username)
+    if conn:
+        try:
+            conn.send(message)
+        except ConnectionError:
+            return False  # disconnecting, or dropped for not reading
+        return True
+    return directory.route(username, ("send", username, message))
+
+def send_file_to_user(username, path, filename, sender):
+    # path belongs to this forward and is deleted once it is sent or dropped.
+    conn = clients.get(username)
+    if conn:
+        conn.send_file(path, filename, sender=sender, on_done=remove_forwarded)
+        return True
+    return directory.route(username, ("file", username, path, filename, sender))
+
+def remove_forwarded(transfer, error):
+    remove_file(transfer.path)
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+def deliver_remote(item):
+    # Items published or routed to this worker by another one, see cluster.py.
+    kind = item[0]
+    if kind == "broadcast":
+        broadcast_local(item[1], channel=item[2])
+        return
+    try:
+        if kind == "send":
+            _, username, message = item
+            if username in clients:
+                clients[username].send(message)
+        elif kind == "file":
+            _, username, path, filename, sender = item
+            if username not in clients:
+                remove_file(path)
+                return
+            try:
+                clients[username].send_file(path, filename, sender=sender, on_done=remove_forwarded)
+            except ConnectionError:
+                remove_file(path)
+    except ConnectionError:
+        pass  # the user is disconnecting
+
 def send_to_targets(message, targets, sender_socket):
     for target in targets:
         target = target.strip()
         if target in clients:
             try:
-                clients[target].sendall(message)
+                send_to_user(target, message)
             except:
                 clients[target].close()
                 del clients[target]
+        else:
+            directory.route(target, ("send", target, message))
 
 def send_invite(sender, target, chat_type):
-    if target not in clients:
-        clients[sender].sendall(f"[SERVER] User {target} not found.\n".encode())
+    if not directory.is_online(target):
+        send_to_user(sender, f"[SERVER] User {target} not found.\n".encode())
         return
     invite = f"[INVITE] {sender} wants to start a {chat_type} chat with you. Accept? (yes/no):"
-    clients[target].sendall(invite.encode())
+    send_to_user(target, invite.encode())
 
 def send_user_list():
-    user_list = "ACTIVE USERS: " + ", ".join(clients.keys())
+    user_list = "ACTIVE USERS: " + ", ".join(directory.users())
     broadcast(user_list.encode())
 
-def receive_file(sock, sender_name, targets=None):
+def receive_file(conn, sender_name, payload, uploads, targets=None):
+    # Handles one FILE channel frame; uploads maps transfer id -> IncomingFile for this sender.
+    # Uploads are stored under a unique name, so a second upload with the same
+    # filename can't truncate a file that is still being forwarded.
     try:
-        meta = sock.recv(1024).decode()
-        filename, filesize = meta.split("|")
-        filesize = int(filesize)
-
-        if filesize <= 0:
-            print(f"[ERROR] Invalid filesize from {sender_name}")
+        kind, transfer_id, body = parse_file_frame(payload)
+        if kind == FILE_START:
+            path = os.path.join(received_dir, f"upload-{os.getpid()}-{next(upload_ids)}")
+            upload = IncomingFile.from_start(received_dir, body, path=path)
+            uploads[transfer_id] = upload
+            print(f"[DEBUG] Receiving file: {upload.filename} ({upload.filesize} bytes) from {sender_name}")
             return
-
-        file_path = os.path.join(received_dir, filename)
-        print(f"[DEBUG] Receiving file: {filename} ({filesize} bytes) from {sender_name}")
-        with open(file_path, "wb") as f:
-            remaining = filesize
-            while remaining > 0:
-                chunk = sock.recv(min(4096, remaining))
-                if not chunk:
-                    break
-                f.write(chunk)
-                remaining -= len(chunk)
-
-        print(f"[INFO] File {filename} received from {sender_name}")
-
-        recipients = targets if targets else [user for user, s in clients.items() if s != sock]
-        for user in recipients:
-            if user in clients:
-                try:
-                    print(f"[DEBUG] Forwarding file to {user}")
-                    clients[user].sendall(b"/file")
-                    clients[user].sendall(meta.encode())
-                    with open(file_path, "rb") as f:
-                        while True:
-                            data = f.read(4096)
-                            if not data:
-                                break
-                            clients[user].sendall(data)
-                except Exception as e:
-                    print(f"[ERROR] Sending file to {user}: {e}")
-    except Exception as e:
+        upload = uploads.get(transfer_id)
+        if upload is None:
+            print(f"[ERROR] Unknown transfer {transfer_id} from {sender_name}")
+            return
+        if kind == FILE_DATA:
+            upload.write(body)
+            return
+        del uploads[transfer_id]
+        if kind == FILE_ABORT:
+            discard_upload(upload)
+            return
+        try:
+            upload.close()
+        except ProtocolError:
+            remove_file(upload.path)  # ended short of the announced size
+            raise
+    except (ProtocolError, ValueError, OSError) as e:
         print(f"[ERROR] File reception error: {e}")
+        return
+
+    print(f"[INFO] File {upload.filename} received from {sender_name}")
+    recipients = targets if targets else [user for user in directory.users() if user != sender_name]
+    for i, user in enumerate(recipients):
+        if not directory.is_online(user):
+            continue
+        # Every forward gets its own link to the upload and deletes it when done.
+        path = f"{upload.path}.{i}"
+        sent = False
+        try:
+            print(f"[DEBUG] Forwarding file to {user}")
+            link_or_copy(upload.path, path)
+            sent = send_file_to_user(user, path, upload.filename, sender_name)
+        except Exception as e:
+            print(f"[ERROR] Sending file to {user}: {e}")
+        if not sent:
+            remove_file(path)
+    remove_file(upload.path)
+
+def link_or_copy(source, destination):
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+def discard_upload(upload):
+    upload.abort()
+    remove_file(upload.path)
 
 def initialize_game(player1, player2):
     return {
@@ -170,188 +302,514 @@ def send_game_state(game, player1, player2):
     message = f"[TIC_TAC_TOE]:STATE:{board_str}:{game['current_player']}"
     print(f"[DEBUG] Sending game state to {player1} and {player2}: {message}")
     try:
-        if player1 in clients:
-            clients[player1].sendall(message.encode())
-        else:
+        if not send_to_user(player1, message.encode()):
             print(f"[DEBUG] {player1} not in clients")
-        if player2 in clients:
-            clients[player2].sendall(message.encode())
-        else:
+        if not send_to_user(player2, message.encode()):
             print(f"[DEBUG] {player2} not in clients")
     except Exception as e:
         print(f"[ERROR] Sending game state: {e}")
 
-def handle_client(conn, addr):
+def handle_game_message(username, parts):
+    # Called with directory.games_lock held.
+    action = parts[1]
+    if action == "REQUEST":
+        target = parts[2]
+        if not directory.is_online(target):
+            clients[username].send(f"[SERVER] User {target} not found.\n".encode())
+            return
+        game_key = tuple(sorted([username, target]))
+        if game_key in games or game_key in pending_games:
+            clients[username].send(f"[SERVER] Game already exists or pending with {target}.\n".encode())
+            return
+        pending_games[game_key] = {'inviter': username, 'target': target}
+        invite = f"[TIC_TAC_TOE]:INVITE:{username}"
+        send_to_user(target, invite.encode())
+    elif action == "ACCEPT":
+        opponent = parts[2]
+        game_key = tuple(sorted([username, opponent]))
+        if game_key not in pending_games:
+            clients[username].send(f"[SERVER] No pending game invitation from {opponent}.\n".encode())
+            return
+        games[game_key] = initialize_game(pending_games[game_key]['inviter'], username)
+        player1, player2 = games[game_key]['player1'], games[game_key]['player2']
+        send_to_user(player1, f"[TIC_TAC_TOE]:START:{player2}:X".encode())
+        send_to_user(player2, f"[TIC_TAC_TOE]:START:{player1}:O".encode())
+        send_game_state(games[game_key], player1, player2)
+        clients[username].send(f"[SERVER] Tic-Tac-Toe started with {opponent}. You are O.\n".encode())
+        send_to_user(opponent, f"[SERVER] Tic-Tac-Toe started with {username}. You are X.\n".encode())
+        pending_games.pop(game_key, None)
+    elif action == "REJECT":
+        opponent = parts[2]
+        game_key = tuple(sorted([username, opponent]))
+        if game_key in pending_games:
+            send_to_user(opponent, f"[SERVER] {username} rejected your Tic-Tac-Toe invitation.\n".encode())
+            pending_games.pop(game_key, None)
+    elif action == "MOVE":
+        opponent = parts[2]
+        row, col = int(parts[3]), int(parts[4])
+        game_key = tuple(sorted([username, opponent]))
+        if game_key not in games:
+            clients[username].send(f"[TIC_TAC_TOE]:ERROR:{opponent}:No active game with {opponent}.".encode())
+            return
+        game = games[game_key]
+        if game['current_player'] != username:
+            clients[username].send(f"[TIC_TAC_TOE]:ERROR:{opponent}:Not your turn.".encode())
+            return
+        if not (0 <= row < 3 and 0 <= col < 3) or game['board'][row][col] != ' ':
+            clients[username].send(f"[TIC_TAC_TOE]:ERROR:{opponent}:Invalid move.".encode())
+            return
+        symbol = game['symbols'][username]
+        game['board'][row][col] = symbol
+        game['turn_count'] += 1
+        game['current_player'] = game['player2'] if game['current_player'] == game['player1'] else game['player1']
+        games[game_key] = game  # the shared table in prefork mode hands out copies
+        print(f"[DEBUG] Updated current_player to {game['current_player']}")
+        send_game_state(game, game['player1'], game['player2'])
+        if check_winner(game['board'], symbol):
+            clients[username].send(f"[TIC_TAC_TOE]:RESULT:You win!".encode())
+            send_to_user(opponent, f"[TIC_TAC_TOE]:RESULT:{username} wins!".encode())
+            games.pop(game_key, None)
+        elif is_board_full(game['board']):
+            clients[username].send(f"[TIC_TAC_TOE]:RESULT:Draw!".encode())
+            send_to_user(opponent, f"[TIC_TAC_TOE]:RESULT:Draw!".encode())
+            games.pop(game_key, None)
+
+def handle_message(conn, username, msg):
+    # Returns False when the client logs out.
+    if msg.startswith("[DM_REQUEST]"):
+        _, target = msg.strip().split(":")
+        send_invite(username, target, "DM")
+
+    elif msg.startswith("[GC_REQUEST]"):
+        participants = msg.strip().split(":")[1:]
+        for user in participants:
+            send_invite(username, user, "Group Chat")
+
+    elif msg.startswith("[INVITE_REPLY]"):
+        _, sender, reply = msg.strip().split(":")
+        if reply == "yes":
+            send_to_user(sender, f"[SERVER] {username} accepted your invitation.\n".encode())
+        else:
+            send_to_user(sender, f"[SERVER] {username} rejected your invitation.\n".encode())
+
+    elif msg.startswith("[TIC_TAC_TOE]"):
+        with directory.games_lock:  # workers in prefork mode change the same tables
+            handle_game_message(username, msg.split(":"))
+
+    elif msg.startswith("/to:"):
+        try:
+            target_line, msg_body = msg[4:].split("|", 1)
+            target_users = target_line.split(",")
+            formatted = f"[DM from {username}]: {msg_body}"
+            send_to_targets(formatted.encode(), target_users, conn)
+        except Exception as e:
+            conn.send(f"[ERROR] Failed to send DM: {e}".encode())
+
+    elif msg.startswith("["):
+        if msg.encode().startswith(SERVER_PREFIXES):
+            print(f"[DEBUG] Refused to relay server command from {username}: {msg}")
+            conn.send(b"[SERVER] Messages can't start with a server command.\n")
+        elif "_MSG]:" in msg:
+            chat_name, message = msg.split("_MSG]:", 1)
+            chat_name = chat_name.strip("[")
+            broadcast(f"[{chat_name}_MSG]:{message}".encode(), exclude=conn, channel=CHAT)
+        else:
+            broadcast(msg.encode(), exclude=conn, channel=CHAT)
+
+    elif msg == "[LOGOUT]" or msg == "/exit":
+        return False
+
+    else:
+        broadcast(f"{username}: {msg}".encode(), exclude=conn, channel=CHAT)
+    return True
+
+def handle_client(sock, addr, context):
     username = None
+    uploads = {}
+    try:
+        sock = context.wrap_socket(sock, server_side=True)  # TLS handshake runs on this thread, not the accept loop
+    except (ssl.SSLError, OSError) as e:
+        print(f"[-] TLS handshake with {addr} failed: {e}")
+        sock.close()
+        return
+    conn = Connection(sock)
+    session_token = None
+    record_id = None
     try:
         while not username:
             username = authenticate(conn)
         with lock:
             clients[username] = conn
             client_names[conn] = username
+        directory.register(username)
+        session_token = new_session(conn, username)
+        if recorder:
+            record_id = recorder.open(username)
 
-        conn.sendall(f"[SERVER] Welcome {username}!\n".encode())
+        conn.send(f"[SERVER] Welcome {username}!\n".encode())
         print(f"[+] {username} connected from {addr}")
         send_user_list()
         broadcast(f"[SERVER] {username} joined the chat.\n".encode(), exclude=conn)
 
         while True:
-            data = conn.recv(4096)
-            if not data:
+            frame = conn.recv_frame()
+            if frame is None:
                 break
-
-            msg = data.decode(errors="ignore")
-            print(f"[DEBUG] Received from {username}: {msg}")
-            if msg.startswith("[DM_REQUEST]"):
-                _, target = msg.strip().split(":")
-                send_invite(username, target, "DM")
-
-            elif msg.startswith("[GC_REQUEST]"):
-                participants = msg.strip().split(":")[1:]
-                for user in participants:
-                    send_invite(username, user, "Group Chat")
-
-            elif msg.startswith("[INVITE_REPLY]"):
-                _, sender, reply = msg.strip().split(":")
-                if reply == "yes":
-                    clients[sender].sendall(f"[SERVER] {username} accepted your invitation.\n".encode())
-                else:
-                    clients[sender].sendall(f"[SERVER] {username} rejected your invitation.\n".encode())
-
-            elif msg.startswith("[TIC_TAC_TOE]"):
-                parts = msg.split(":")
-                action = parts[1]
-                if action == "REQUEST":
-                    target = parts[2]
-                    if target not in clients:
-                        clients[username].sendall(f"[SERVER] User {target} not found.\n".encode())
-                        continue
-                    game_key = tuple(sorted([username, target]))
-                    if game_key in games or game_key in pending_games:
-                        clients[username].sendall(f"[SERVER] Game already exists or pending with {target}.\n".encode())
-                        continue
-                    pending_games[game_key] = {'inviter': username, 'target': target}
-                    invite = f"[TIC_TAC_TOE]:INVITE:{username}"
-                    clients[target].sendall(invite.encode())
-                elif action == "ACCEPT":
-                    opponent = parts[2]
-                    game_key = tuple(sorted([username, opponent]))
-                    if game_key not in pending_games:
-                        clients[username].sendall(f"[SERVER] No pending game invitation from {opponent}.\n".encode())
-                        continue
-                    games[game_key] = initialize_game(pending_games[game_key]['inviter'], username)
-                    player1, player2 = games[game_key]['player1'], games[game_key]['player2']
-                    clients[player1].sendall(f"[TIC_TAC_TOE]:START:{player2}:X".encode())
-                    clients[player2].sendall(f"[TIC_TAC_TOE]:START:{player1}:O".encode())
-                    send_game_state(games[game_key], player1, player2)
-                    clients[username].sendall(f"[SERVER] Tic-Tac-Toe started with {opponent}. You are O.\n".encode())
-                    clients[opponent].sendall(f"[SERVER] Tic-Tac-Toe started with {username}. You are X.\n".encode())
-                    del pending_games[game_key]
-                elif action == "REJECT":
-                    opponent = parts[2]
-                    game_key = tuple(sorted([username, opponent]))
-                    if game_key in pending_games:
-                        clients[opponent].sendall(f"[SERVER] {username} rejected your Tic-Tac-Toe invitation.\n".encode())
-                        del pending_games[game_key]
-                elif action == "MOVE":
-                    opponent = parts[2]
-                    row, col = int(parts[3]), int(parts[4])
-                    game_key = tuple(sorted([username, opponent]))
-                    if game_key not in games:
-                        clients[username].sendall(f"[TIC_TAC_TOE]:ERROR:{opponent}:No active game with {opponent}.".encode())
-                        continue
-                    game = games[game_key]
-                    if game['current_player'] != username:
-                        clients[username].sendall(f"[TIC_TAC_TOE]:ERROR:{opponent}:Not your turn.".encode())
-                        continue
-                    if not (0 <= row < 3 and 0 <= col < 3) or game['board'][row][col] != ' ':
-                        clients[username].sendall(f"[TIC_TAC_TOE]:ERROR:{opponent}:Invalid move.".encode())
-                        continue
-                    symbol = game['symbols'][username]
-                    game['board'][row][col] = symbol
-                    game['turn_count'] += 1
-                    game['current_player'] = game['player2'] if game['current_player'] == game['player1'] else game['player1']
-                    print(f"[DEBUG] Updated current_player to {game['current_player']}")
-                    send_game_state(game, game['player1'], game['player2'])
-                    if check_winner(game['board'], symbol):
-                        clients[username].sendall(f"[TIC_TAC_TOE]:RESULT:You win!".encode())
-                        clients[opponent].sendall(f"[TIC_TAC_TOE]:RESULT:{username} wins!".encode())
-                        del games[game_key]
-                    elif is_board_full(game['board']):
-                        clients[username].sendall(f"[TIC_TAC_TOE]:RESULT:Draw!".encode())
-                        clients[opponent].sendall(f"[TIC_TAC_TOE]:RESULT:Draw!".encode())
-                        del games[game_key]
-
-            elif msg.startswith("[FILE]"):
-                _, filename, size = msg.strip().split(":")
-                size = int(size)
-                content = conn.recv(size)
-                broadcast(f"[FILE]:{filename}:{username}:{size}".encode(), exclude=conn)
-                broadcast(content, exclude=conn)
-
-            elif msg.startswith("/file"):
-                receive_file(conn, username)
-
-            elif msg.startswith("/to:"):
+            channel, data = frame
+            tracer = diagnostics.tracer
+            trace = tracer.begin(username, channel) if tracer else None
+            if record_id:
+                recorder.frame(record_id, channel, data)
+            if channel == FILE:
                 try:
-                    target_line, msg_body = msg[4:].split("|", 1)
-                    target_users = target_line.split(",")
-                    formatted = f"[DM from {username}]: {msg_body}"
-                    send_to_targets(formatted.encode(), target_users, conn)
-                except Exception as e:
-                    conn.sendall(f"[ERROR] Failed to send DM: {e}".encode())
-
-            elif msg.startswith("["):
-                if "_MSG]:" in msg:
-                    chat_name, message = msg.split("_MSG]:", 1)
-                    chat_name = chat_name.strip("[")
-                    broadcast(f"[{chat_name}_MSG]:{message}".encode(), exclude=conn)
-                else:
-                    broadcast(msg.encode(), exclude=conn)
-
-            elif msg == "[LOGOUT]" or msg == "/exit":
-                break
+                    receive_file(conn, username, data, uploads)
+                finally:
+                    if trace:
+                        tracer.end(trace)
+                continue
 
-            else:
-                broadcast(f"{username}: {msg}".encode(), exclude=conn)
+            try:
+                msg = data.decode(errors="ignore")
+                if trace:
+                    trace.mark("parse", type=message_type(channel, data), size=len(data))
+                print(f"[DEBUG] Received from {username}: {msg}")
+                if trace:
+                    trace.mark("dispatch")
+                keep_going = handle_message(conn, username, msg)
+            finally:
+                if trace:
+                    tracer.end(trace)  # also when handle_message raises, so later sends aren't attributed to it
+            if not keep_going:
+                break
 
     except Exception as e:
         print(f"[-] Error with {username or addr}: {e}")
     finally:
         print(f"[-] {username} disconnected.")
+        if record_id:
+            recorder.close(record_id)
         with lock:
             if username in clients:
                 del clients[username]
             if conn in client_names:
                 del client_names[conn]
-            for game_key in list(games.keys()):
-                if username in game_key:
-                    opponent = game_key[0] if game_key[1] == username else game_key[1]
-                    if opponent in clients:
-                        clients[opponent].sendall(f"[TIC_TAC_TOE]:RESULT:{username} disconnected. Game ended.".encode())
-                    del games[game_key]
-            for game_key in list(pending_games.keys()):
-                if username in game_key:
-                    opponent = game_key[0] if game_key[1] == username else game_key[1]
-                    if opponent in clients:
-                        clients[opponent].sendall(f"[SERVER] {username} disconnected. Tic-Tac-Toe invitation canceled.\n".encode())
-                    del pending_games[game_key]
-        broadcast(f"[SERVER] {username} left the chat.\n".encode())
-        send_user_list()
+            directory.unregister(username)
+            if draining.is_set():
+                # Moving to the new server: keep the session and leave games for the handoff.
+                session_token = None
+            with directory.games_lock:
+                for game_key in list(games.keys()) if session_token else []:
+                    if username in game_key and games.pop(game_key, None):
+                        opponent = game_key[0] if game_key[1] == username else game_key[1]
+                        send_to_user(opponent, f"[TIC_TAC_TOE]:RESULT:{username} disconnected. Game ended.".encode())
+                for game_key in list(pending_games.keys()) if session_token else []:
+                    if username in game_key and pending_games.pop(game_key, None):
+                        opponent = game_key[0] if game_key[1] == username else game_key[1]
+                        send_to_user(opponent, f"[SERVER] {username} disconnected. Tic-Tac-Toe invitation canceled.\n".encode())
+            if session_token:
+                directory.sessions.pop(session_token, None)
+        for upload in uploads.values():
+            discard_upload(upload)
+        if not draining.is_set():
+            broadcast(f"[SERVER] {username} left the chat.\n".encode())
+            send_user_list()
         conn.close()
 
 # --- SSL Context ---
-context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-context.load_cert_chain(certfile="cert.pem", keyfile="key.pem")
+def create_ssl_context():
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile="cert.pem", keyfile="key.pem")
+    return context
 
 # --- Start Server ---
-with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-    s.bind((HOST, PORT))
-    s.listen()
-    print(f"SSL Server running at {HOST}:{PORT}")
+def create_listener(host, port, reuse_port=False):
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    s.bind((host, port))
+    s.listen(128)
+    return s
+
+def accept_clients(listener, context, should_stop):
+    listener.settimeout(1.0)  # wake up regularly to notice restart and drain requests
+    while not should_stop():
+        try:
+            sock, addr = listener.accept()
+        except socket.timeout:
+            continue
+        sock.setblocking(True)
+        thread = threading.Thread(target=handle_client, args=(sock, addr, context), daemon=True)
+        thread.start()
+
+def set_directory(shared_directory):
+    global directory, games, pending_games
+    directory = shared_directory
+    games = directory.games
+    pending_games = directory.pending_games
+
+# --- Graceful restart ---
+# SIGHUP starts a new server process and hands it the listening sockets, so
+# it accepts new connections right away. This process then asks its clients
+# to reconnect with their session token, spread over DRAIN_WINDOW seconds.
+# Game players go last; once they are gone the game tables are handed over.
+
+def request_restart(signum, frame):
+    global restart_requested
+    restart_requested = True
+
+def request_drain(signum, frame):
+    global drain_requested
+    drain_requested = True
+
+def successor_args(args):
+    successor = ["--host", args.host, "--port", str(args.port), "--workers", str(args.workers),
+                 "--drain-window", str(args.drain_window)]
+    if args.record:
+        successor += ["--record", args.record]
+    if args.redact:
+        successor.append("--redact")
+    if args.admin:
+        successor += ["--admin", args.admin]
+    return successor
+
+def begin_handoff(listeners, args):
+    process, channel = start_successor(os.path.abspath(__file__), successor_args(args))
+    channel.send_listeners(listeners)
+    sessions = sessions_for_handoff()
+    channel.send("sessions", sessions=sessions, redact_key=redactor.key.hex() if redactor else None)
+    print(f"[INFO] Listening socket handed to pid {process.pid}, draining clients for {args.drain_window}s")
+    return channel, set(sessions)
+
+def finish_handoff(channel, sent_tokens):
+    # Only sessions created after begin_handoff; the others may already have been used.
+    sessions = sessions_for_handoff(skip=sent_tokens)
+    channel.send("sessions", sessions=sessions)
+    channel.send("games", games=encode_table(games), pending_games=encode_table(pending_games))
+    channel.close()
+    print(f"[INFO] Handed over {len(games)} games, exiting")
+
+def sessions_for_handoff(skip=()):
+    # Sessions of connected users start expiring now; tokens nobody came back
+    # with in time (including ones handed to us by an earlier restart) are dropped.
+    now = time.time()
+    sessions = {}
+    for token, (username, expires) in list(directory.sessions.items()):
+        if expires is not None and expires < now:
+            directory.sessions.pop(token, None)
+        elif token not in skip:
+            sessions[token] = (username, expires if expires is not None else now + session_ttl)
+    return sessions
+
+def adopt_handoff(fd):
+    # Runs in the new server, before it starts accepting.
+    channel = open_handoff(fd)
+    listeners, _ = channel.receive_listeners()
+    print(f"[INFO] Took over {len(listeners)} listening sockets from the previous server")
+    return listeners, channel
+
+def take_over_state(channel):
+    # Sessions follow the sockets immediately and are applied before the first
+    # accept; the game tables only come once the old server has drained.
+    messages = channel.messages()
+    apply_handoff_message(next(messages, {"type": "end"}))
+    threading.Thread(target=apply_handoff_messages, args=(channel, messages), daemon=True).start()
+
+def apply_handoff_messages(channel, messages):
+    for message in messages:
+        apply_handoff_message(message)
+    channel.close()
+
+def apply_handoff_message(message):
+    global redactor
+    if message["type"] == "sessions":
+        directory.sessions.update({token: tuple(entry) for token, entry in message["sessions"].items()})
+        if message.get("redact_key"):
+            redactor = Redactor(bytes.fromhex(message["redact_key"]))  # same pseudonyms as before the restart
+    elif message["type"] == "games":
+        handed_games = decode_table(message["games"])
+        pending_games.update(decode_table(message["pending_games"]))
+        games.update(handed_games)
+        for game in handed_games.values():
+            send_game_state(game, game['player1'], game['player2'])
+        print(f"[INFO] Took over {len(handed_games)} games from the previous server")
+
+def drain_clients(window):
+    draining.set()
+    with lock:
+        users = list(clients)
+    players = {player for game_key in list(games.keys()) for player in game_key}
+    others = [user for user in users if user not in players]
+    random.shuffle(others)
+    for i, username in enumerate(others):
+        delay = window * (i + random.random()) / len(others)
+        try:
+            clients[username].send(f"[RECONNECT]:{delay:.2f}".encode())
+        except (KeyError, ConnectionError):
+            pass
+
+    deadline = time.time() + window
+    while time.time() < deadline and any(user not in players for user in list(clients)):
+        time.sleep(0.5)
+    with lock:
+        remaining = list(clients.values())
+    for conn in remaining:
+        try:
+            conn.send(b"[RECONNECT]:1.00")
+        except ConnectionError:
+            pass
+        conn.close()
+    for conn in remaining:
+        conn.close(timeout=2)
+    print(f"[INFO] Drained {len(users)} clients")
+
+def capture_path(args):
+    # A server started by a restart writes next to its predecessor's capture, not over it.
+    if args.handoff_fd is not None:
+        return f"{args.record}.{os.getpid()}"
+    return args.record
+
+def create_redactor(args):
+    global redactor
+    if args.redact and redactor is None:
+        redactor = Redactor()
+    return redactor
+
+def start_recording(path, redactor, connection_base=0):
+    global recorder
+    recorder = Recorder(path, redactor, connection_base)
+    print(f"[INFO] Recording inbound traffic to {path}{' (redacted)' if redactor else ''}")
+
+def stop_recording():
+    if recorder:
+        recorder.stop()
+
+def server_status():
+    return {"pid": os.getpid(), "clients": len(clients), "online": len(directory.users()),
+            "games": len(games), "threads": threading.active_count(), "draining": draining.is_set()}
+
+def run_worker(worker_id, listener, shared_directory, args, capture):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the parent stops workers with SIGTERM
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGUSR1, request_drain)
+    set_directory(shared_directory)
+    directory.attach(worker_id, deliver_remote)
+    if args.record:
+        start_recording(f"{capture}.{worker_id}", redactor, worker_id << 24)
+    if args.admin:
+        diagnostics.start_admin(f"{args.admin}.{worker_id}", server_status)
+    print(f"[INFO] Worker {worker_id} (pid {os.getpid()}) accepting connections")
+    try:
+        accept_clients(listener, create_ssl_context(), lambda: drain_requested)
+        listener.close()
+        drain_clients(args.drain_window)
+    finally:
+        diagnostics.stop_admin()
+        stop_recording()
+
+def run_prefork(args, worker_count, listeners, channel=None):
+    # One listening socket per worker, all bound to the same port with
+    # SO_REUSEPORT so the kernel spreads new connections across them. The
+    # parent keeps its copies so it can hand them to a successor.
+    shared_directory = SharedDirectory(worker_count)
+    set_directory(shared_directory)
+    while len(listeners) < worker_count:
+        listeners.append(create_listener(args.host, args.port, reuse_port=True))
+    for extra in listeners[worker_count:]:
+        extra.close()
+    listeners = listeners[:worker_count]
+    if channel:
+        take_over_state(channel)
+
+    create_redactor(args)  # before forking, so pseudonyms match across workers
+    capture = capture_path(args) if args.record else None
+    fork = multiprocessing.get_context("fork")
+    workers = []
+    for worker_id, listener in enumerate(listeners):
+        worker = fork.Process(target=run_worker, args=(worker_id, listener, shared_directory, args, capture),
+                              daemon=True)
+        worker.start()
+        workers.append(worker)
+    print(f"SSL Server running at {args.host}:{args.port} with {worker_count} workers")
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while all(worker.is_alive() for worker in workers) and not restart_requested:
+            workers[0].join(1)
+        if restart_requested:
+            channel, sent_tokens = begin_handoff(listeners, args)
+            for worker in workers:
+                os.kill(worker.pid, signal.SIGUSR1)
+            for worker in workers:
+                worker.join(args.drain_window + 10)
+            finish_handoff(channel, sent_tokens)
+        else:
+            print("[ERROR] A worker exited, shutting down")
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+
+def main():
+    global session_ttl
+    parser = argparse.ArgumentParser(description="Secure chat server")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes sharing the port via SO_REUSEPORT (0 = one per CPU core)")
+    parser.add_argument("--drain-window", type=float, default=DRAIN_WINDOW,
+                        help="seconds to spread client reconnects over on restart (SIGHUP)")
+    parser.add_argument("--record", metavar="PATH",
+                        help="capture inbound frames for replay.py (one PATH.<worker> file per worker)")
+    parser.add_argument("--redact", action="store_true",
+                        help="with --record, replace names and message text with pseudonyms and filler")
+    parser.add_argument("--admin", metavar="PATH",
+                        help="Unix socket for profiling and tracing commands (one PATH.<worker> per worker)")
+    parser.add_argument("--handoff-fd", type=int, help=argparse.SUPPRESS)  # set by a restarting server
+    args = parser.parse_args()
+    worker_count = args.workers or os.cpu_count() or 1
+    session_ttl = 2 * args.drain_window
+
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, request_restart)
+
+    if worker_count > 1:
+        if not hasattr(socket, "SO_REUSEPORT"):
+            print("[ERROR] SO_REUSEPORT is not available on this platform, use --workers 1")
+            sys.exit(1)
+        listeners, channel = adopt_handoff(args.handoff_fd) if args.handoff_fd is not None else ([], None)
+        run_prefork(args, worker_count, listeners, channel)
+        return
 
-    with context.wrap_socket(s, server_side=True) as ssock:
-        while True:
-            conn, addr = ssock.accept()
-            thread = threading.Thread(target=handle_client, args=(conn, addr), daemon=True)
-            thread.start()
\ No newline at end of file
+    context = create_ssl_context()
+    if args.handoff_fd is not None:
+        listeners, channel = adopt_handoff(args.handoff_fd)
+        take_over_state(channel)
+        for extra in listeners[1:]:
+            extra.close()
+        s = listeners[0]
+    else:
+        s = create_listener(args.host, args.port)
+    if args.record:
+        start_recording(capture_path(args), create_redactor(args))
+    if args.admin:
+        diagnostics.start_admin(args.admin, server_status)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))  # so the capture gets flushed
+    with s:
+        print(f"SSL Server running at {args.host}:{args.port}")
+        try:
+            accept_clients(s, context, lambda: restart_requested)
+            channel, sent_tokens = begin_handoff([s], args)
+            drain_clients(args.drain_window)
+            finish_handoff(channel, sent_tokens)
+        finally:
+            diagnostics.stop_admin()
+            stop_recording()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,170 @@
+import hashlib
+import hmac
+import os
+import struct
+import threading
+import time
+from protocol import FILE, FILE_HEADER, FILE_START, FILE_DATA, parse_file_frame
+
+# --- Traffic capture format ---
+# A capture file is FILE_MAGIC, the wall-clock start time, then records:
+#   time since start (microseconds), connection id, kind, channel, flags,
+#   payload length, payload (absent when FLAG_ELIDED is set).
+# OPEN carries the username, FRAME one inbound frame, CLOSE nothing.
+# Login frames are never recorded; replay.py logs in on its own.
+
+FILE_MAGIC = b"CHATREC1"
+START_HEADER = struct.Struct("!d")
+RECORD_HEADER = struct.Struct("!QIBBBI")
+OPEN = 0
+FRAME = 1
+CLOSE = 2
+FLAG_ELIDED = 1  # payload bytes not stored, only their length (file data)
+
+def message_type(channel, payload):
+    if channel == FILE:
+        return "file"
+    if payload.startswith(b"[TIC_TAC_TOE]:MOVE"):
+        return "game_move"
+    if payload.startswith(b"[TIC_TAC_TOE]"):
+        return "game"
+    if payload.startswith((b"[DM_REQUEST]", b"[GC_REQUEST]", b"[INVITE_REPLY]")):
+        return "invite"
+    if payload in (b"[LOGOUT]", b"/exit"):
+        return "logout"
+    if payload.startswith(b"/to:"):
+        return "dm"
+    if payload.startswith(b"[") and b"_MSG]:" in payload:
+        return "room"
+    return "chat"
+
+class Redactor:
+    # Replaces usernames, room and file names with keyed pseudonyms and
+    # message text with filler of the same byte length. The key is random per
+    # server start, so pseudonyms are stable within a capture (and across
+    # prefork workers, which inherit it) but can't be reversed afterwards.
+    def __init__(self, key=None):
+        self.key = key or os.urandom(16)
+
+    def name(self, value, prefix="u"):
+        if not value:
+            return value
+        return prefix + hmac.new(self.key, value.encode(), hashlib.sha256).hexdigest()[:10]
+
+    def redact(self, channel, payload):
+        if channel == FILE:
+            kind, transfer_id, body = parse_file_frame(payload)
+            if kind != FILE_START:
+                return payload
+            filename, size, _ = body.decode(errors="ignore").split("|", 2)
+            extension = os.path.splitext(filename)[1][:8]
+            meta = f"{self.name(filename, 'f')}{extension}|{size}|"
+            return FILE_HEADER.pack(kind, transfer_id) + meta.encode()
+
+        text = payload.decode(errors="ignore")
+        kind = message_type(channel, payload)
+        if kind == "logout":
+            return payload
+        if kind in ("invite", "game"):
+            parts = text.split(":")
+            if text.startswith("[TIC_TAC_TOE]"):
+                if len(parts) > 2:
+                    parts[2] = self.name(parts[2])
+            elif text.startswith("[INVITE_REPLY]"):
+                parts[1] = self.name(parts[1])
+            else:
+                parts[1:] = [self.name(part) for part in parts[1:]]
+            return ":".join(parts).encode()
+        if kind == "game_move":
+            parts = text.split(":")
+            parts[2] = self.name(parts[2])
+            return ":".join(parts).encode()
+        if kind == "dm":
+            targets, _, body = text[4:].partition("|")
+            targets = ",".join(self.name(target.strip()) for target in targets.split(","))
+            return f"/to:{targets}|".encode() + filler(body)
+        if kind == "room":
+            chat_name, _, body = text.partition("_MSG]:")
+            return f"[{self.name(chat_name.strip('['), 'r')}_MSG]:".encode() + filler(body)
+        return filler(text)
+
+def filler(text):
+    return b"x" * len(text.encode())
+
+class Recorder:
+    # Appends records for inbound frames; shared by all client threads.
+    def __init__(self, path, redactor=None, connection_base=0):
+        self.file = open(path, "wb", buffering=256 * 1024)
+        self.file.write(FILE_MAGIC + START_HEADER.pack(time.time()))
+        self.file.flush()  # a capture is readable (if empty) while the server still runs
+        self.start = time.monotonic()
+        self.redactor = redactor
+        self.lock = threading.Lock()
+        self.next_id = connection_base
+        self.last_flush = self.start
+
+    def open(self, username):
+        with self.lock:
+            self.next_id += 1
+            connection_id = self.next_id
+        if self.redactor:
+            username = self.redactor.name(username)
+        self._write(connection_id, OPEN, 0, username.encode())
+        return connection_id
+
+    def frame(self, connection_id, channel, payload):
+        # Never raises, so recording can't change how the server handles a frame.
+        try:
+            if self.redactor:
+                try:
+                    payload = self.redactor.redact(channel, payload)
+                except Exception:
+                    payload = b"x" * len(payload)  # malformed frame: keep only its length
+            if channel == FILE and len(payload) >= FILE_HEADER.size and payload[:1] == bytes([FILE_DATA]):
+                self._write(connection_id, FRAME, channel, payload[:FILE_HEADER.size],
+                            FLAG_ELIDED, len(payload) - FILE_HEADER.size)
+            else:
+                self._write(connection_id, FRAME, channel, payload)
+        except Exception as e:
+            print(f"[ERROR] Recording frame from connection {connection_id}: {e}")
+
+    def close(self, connection_id):
+        self._write(connection_id, CLOSE, 0, b"")
+
+    def stop(self):
+        with self.lock:
+            self.file.close()
+
+    def _write(self, connection_id, kind, channel, payload, flags=0, elided=0):
+        # For elided records the stored payload is just the file frame header
+        # and `length` counts the bytes that were dropped after it.
+        with self.lock:
+            if self.file.closed:
+                return
+            now = time.monotonic()  # under the lock, so records stay in time order for replay's merge
+            header = RECORD_HEADER.pack(int((now - self.start) * 1e6), connection_id, kind, channel, flags,
+                                        len(payload) + elided)
+            self.file.write(header)
+            self.file.write(payload)
+            if now - self.last_flush > 1.0:
+                self.file.flush()
+                self.last_flush = now
+
+def read_capture(path):
+    # Yields (wall time, connection id, kind, channel, payload) records.
+    # Elided file data comes back as zero bytes of the original length.
+    with open(path, "rb") as f:
+        if f.read(len(FILE_MAGIC)) != FILE_MAGIC:
+            raise ValueError(f"{path} is not a traffic capture")
+        (start,) = START_HEADER.unpack(f.read(START_HEADER.size))
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            offset, connection_id, kind, channel, flags, length = RECORD_HEADER.unpack(header)
+            if flags & FLAG_ELIDED:
+                payload = f.read(FILE_HEADER.size)
+                payload += bytes(length - FILE_HEADER.size)
+            else:
+                payload = f.read(length)
+            yield start + offset / 1e6, connection_id, kind, channel, payload